@@ -0,0 +1,257 @@
+"""
+Translation for asyncio programs.
+
+    loop = asyncio.get_event_loop()
+    python = loop.run_until_complete(translate_async('n <- 1'))
+
+translate() blocks its thread while R parses. translate_async() is a
+coroutine that talks to a `cue.r --server` process through non-blocking
+pipes instead, so many translations can be in flight on one event loop
+without threads.
+
+This is written for trollius, the asyncio backport for Python 2, so
+coroutines use `yield From(...)` and `raise Return(...)`.
+"""
+import atexit
+
+import trollius as asyncio
+from trollius import From, Return
+
+from translate import (CUE_SCRIPT, CueError, CueTimeout, cue_error,
+                       cue_options, limit_resources, translate_cue_code,
+                       Transformer)
+
+
+class AsyncCueWorker(object):
+
+    """
+    A long-lived `Rscript cue.r --server` process driven from an event
+    loop. This speaks the same protocol as translate.CueWorker.
+
+    Requests are served one at a time, in the order they arrive. If a
+    request is cancelled, or times out, while R is still answering it, the
+    process is killed, since its reply can no longer be matched up with a
+    request. The next request starts a fresh one.
+
+    `memory` and `cpu` limit the R process as they do for CueWorker.
+    """
+
+    def __init__(self, script=CUE_SCRIPT, format='text', srcref=False,
+                 memory=None, cpu=None, loop=None):
+        self.script = script
+        self.format = format
+        self.options = cue_options(format, srcref)
+        self.memory = memory
+        self.cpu = cpu
+        self.loop = loop
+        self.proc = None
+        self._lock = asyncio.Lock(loop=loop)
+
+    @asyncio.coroutine
+    def start(self):
+        self.proc = yield From(asyncio.create_subprocess_exec(
+            'Rscript', self.script, '--server', *self.options,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            # A record is one line, and string constants can be long
+            limit=2 ** 24,
+            close_fds=True,
+            preexec_fn=limit_resources(self.memory, self.cpu),
+            loop=self.loop))
+
+    @property
+    def alive(self):
+        return self.proc is not None and self.proc.returncode is None
+
+    def kill(self):
+        proc, self.proc = self.proc, None
+        if proc is not None and proc.returncode is None:
+            proc.kill()
+
+    @asyncio.coroutine
+    def close(self):
+        proc, self.proc = self.proc, None
+        if proc is None:
+            return
+
+        proc.stdin.close()
+        yield From(proc.wait())
+
+    @asyncio.coroutine
+    def _died(self):
+        proc, self.proc = self.proc, None
+        err = yield From(proc.stderr.read())
+        yield From(proc.wait())
+        raise Return(CueError(
+            err or 'cue worker exited with {}'.format(proc.returncode)))
+
+    @asyncio.coroutine
+    def run(self, text):
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+
+        with (yield From(self._lock)):
+            if not self.alive:
+                yield From(self.start())
+
+            try:
+                out = yield From(self._request(text))
+            except (asyncio.CancelledError, asyncio.TimeoutError):
+                self.kill()
+                raise
+
+        raise Return(out)
+
+    @asyncio.coroutine
+    def _request(self, text):
+        try:
+            self.proc.stdin.write('{}\n'.format(len(text)))
+            self.proc.stdin.write(text)
+            yield From(self.proc.stdin.drain())
+        except (IOError, OSError):
+            error = yield From(self._died())
+            raise error
+
+        if self.format == 'framed':
+            out = yield From(self._read_framed())
+        else:
+            out = yield From(self._read_text())
+        raise Return(out)
+
+    @asyncio.coroutine
+    def _read_text(self):
+        lines = []
+        while True:
+            line = yield From(self.proc.stdout.readline())
+            if not line:
+                error = yield From(self._died())
+                raise error
+            if line.rstrip('\n') == '.end':
+                break
+            lines.append(line)
+
+        if lines and lines[-1].startswith('.error'):
+            raise cue_error(lines[-1][len('.error'):].strip())
+
+        raise Return(''.join(lines))
+
+    @asyncio.coroutine
+    def _read_framed(self):
+        stdout = self.proc.stdout
+        chunks = []
+        error = None
+
+        while True:
+            header = yield From(stdout.readline())
+            name, _, size = header.partition(' ')
+            if not size.strip().isdigit():
+                error = yield From(self._died())
+                raise error
+
+            # The value plus its trailing newline
+            try:
+                value = yield From(stdout.readexactly(int(size) + 1))
+            except asyncio.IncompleteReadError:
+                error = yield From(self._died())
+                raise error
+
+            if name == 'end':
+                break
+            elif name == 'error':
+                error = value[:-1]
+            else:
+                chunks += [header, value]
+
+        if error is not None:
+            raise cue_error(error)
+
+        raise Return(''.join(chunks))
+
+
+class AsyncCuePool(object):
+
+    """
+    A fixed set of AsyncCueWorkers. run() waits for an idle worker, so up
+    to `size` R processes parse concurrently and further requests queue.
+    """
+
+    def __init__(self, size=4, script=CUE_SCRIPT, format='text',
+                 srcref=False, memory=None, cpu=None, loop=None):
+        self.size = size
+        self.format = format
+        self.options = cue_options(format, srcref)
+        self._idle = asyncio.Queue(loop=loop)
+        for i in range(size):
+            self._idle.put_nowait(
+                AsyncCueWorker(script, format, srcref, memory, cpu, loop))
+
+    @asyncio.coroutine
+    def run(self, text):
+        worker = yield From(self._idle.get())
+        try:
+            out = yield From(worker.run(text))
+        finally:
+            self._idle.put_nowait(worker)
+        raise Return(out)
+
+    @asyncio.coroutine
+    def close(self):
+        for i in range(self.size):
+            worker = yield From(self._idle.get())
+            yield From(worker.close())
+
+
+_default_worker = None
+
+def default_async_worker():
+    """
+    The shared AsyncCueWorker used when no worker is given, started on
+    first use. It belongs to the event loop that was current then.
+    """
+    global _default_worker
+
+    if _default_worker is None:
+        _default_worker = AsyncCueWorker()
+        atexit.register(_default_worker.kill)
+
+    return _default_worker
+
+
+@asyncio.coroutine
+def run_cue_async(text, worker=None, cache=None, timeout=None):
+    if worker is None:
+        worker = default_async_worker()
+
+    if cache is not None:
+        out = cache.get(text, worker.options)
+        if out is not None:
+            raise Return(out)
+
+    try:
+        out = yield From(asyncio.wait_for(worker.run(text), timeout))
+    except asyncio.TimeoutError:
+        raise CueTimeout('cue.r took longer than {}s'.format(timeout))
+
+    if cache is not None:
+        cache.put(text, out, worker.options)
+
+    raise Return(out)
+
+
+@asyncio.coroutine
+def translate_async(raw, worker=None, cache=None, timeout=None,
+                    transformer=Transformer, optimize=False):
+    """
+    Translate `raw` on `worker`, an AsyncCueWorker or AsyncCuePool, or on
+    the shared default worker.
+
+    Raises CueTimeout if R hasn't answered within `timeout` seconds.
+    Cancelling the returned task abandons the translation.
+    """
+    if worker is None:
+        worker = default_async_worker()
+
+    cue_out = yield From(run_cue_async(raw, worker, cache, timeout))
+    raise Return(translate_cue_code(cue_out, worker.format, transformer,
+                                    optimize))
@@ -0,0 +1,427 @@
+"""
+Benchmarks for the translation pipeline.
+
+    python bench.py [name ...] [--scale S] [--corpus DIR]
+                    [--save FILE] [--compare FILE]
+    python bench.py record DIR FILE.r ...
+
+These run without R: the inputs are synthetic cue.r record streams, and
+the cue.r dumps in the corpus directory. `record` runs cue.r over R
+sources to add them to a corpus, and is the only part that needs R.
+
+--save writes the results as JSON, along with the git commit they were
+measured at; --compare prints each result against a saved file.
+"""
+import argparse
+from collections import deque
+import json
+import os
+import platform
+from StringIO import StringIO
+import subprocess
+import sys
+import time
+
+from reader import _gen_recs, _scan_recs, Node, read_tree
+from translate import (CueError, CueGeneric, Transformer, run_cue_once,
+                       translate_cue_code)
+from unparse import Unparser
+
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'bench_corpus')
+
+
+def _leaf(lines, level, type_, content):
+    lines += ['.level {}'.format(level), '.type ' + type_,
+              '.content {}'.format(content), '']
+
+
+def synthetic_lines(n):
+    """Cue output for `n` statements of the form `xI <- fI(I, 'sI')`."""
+    lines = ['.level 0', '.type expression', '']
+
+    for i in range(n):
+        lines += ['.level 1', '.type language', '']
+        _leaf(lines, 2, 'symbol', '<-')
+        _leaf(lines, 2, 'symbol', 'x{}'.format(i))
+        lines += ['.level 2', '.type language', '']
+        _leaf(lines, 3, 'symbol', 'f{}'.format(i % 10))
+        _leaf(lines, 3, 'double', i)
+        _leaf(lines, 3, 'character', 's{}'.format(i))
+
+    return lines
+
+
+def _binop(lines, level, op, left, right):
+    lines += ['.level {}'.format(level), '.type language', '']
+    _leaf(lines, level + 1, 'symbol', op)
+    _leaf(lines, level + 1, 'double', left)
+    _leaf(lines, level + 1, 'double', right)
+
+
+def synthetic_expr_lines(n):
+    """
+    Cue output for `n` statements of the form
+    `xI <- fI(I + 1, I * 2 > 3 && !I)`, mixing calls, assignment, and
+    arithmetic, comparison, boolean and unary operators.
+    """
+    lines = ['.level 0', '.type expression', '']
+
+    for i in range(n):
+        lines += ['.level 1', '.type language', '']
+        _leaf(lines, 2, 'symbol', '<-')
+        _leaf(lines, 2, 'symbol', 'x{}'.format(i))
+        lines += ['.level 2', '.type language', '']
+        _leaf(lines, 3, 'symbol', 'f{}'.format(i % 10))
+        _binop(lines, 3, '+', i, 1)
+        lines += ['.level 3', '.type language', '']
+        _leaf(lines, 4, 'symbol', '&&')
+        lines += ['.level 4', '.type language', '']
+        _leaf(lines, 5, 'symbol', '>')
+        _binop(lines, 5, '*', i, 2)
+        _leaf(lines, 5, 'double', 3)
+        lines += ['.level 4', '.type language', '']
+        _leaf(lines, 5, 'symbol', '!')
+        _leaf(lines, 5, 'double', i)
+
+    return lines
+
+
+def wide_call_lines(n):
+    """Cue output for one call with `n` arguments, `f(1, 2, ..., n)`."""
+    lines = ['.level 0', '.type expression', '',
+             '.level 1', '.type language', '']
+    _leaf(lines, 2, 'symbol', 'f')
+    for i in range(n):
+        _leaf(lines, 2, 'double', i + 1)
+    return lines
+
+
+def deep_nesting_lines(n):
+    """Cue output for `1 + (2 + (3 + ... n))`, nested `n` deep."""
+    lines = ['.level 0', '.type expression', '']
+
+    level = 1
+    for i in range(1, n):
+        lines += ['.level {}'.format(level), '.type language', '']
+        _leaf(lines, level + 1, 'symbol', '+')
+        _leaf(lines, level + 1, 'double', i)
+        lines += ['.level {}'.format(level + 1), '.type language', '']
+        _leaf(lines, level + 2, 'symbol', '(')
+        level += 2
+
+    _leaf(lines, level, 'double', n)
+    return lines
+
+
+def long_chain_lines(n):
+    """Cue output for `1 + 2 + ... + n`, a left-nested chain."""
+    lines = ['.level 0', '.type expression', '']
+    for level in range(1, n):
+        lines += ['.level {}'.format(level), '.type language', '']
+        _leaf(lines, level + 1, 'symbol', '+')
+    _leaf(lines, n, 'double', 1)
+    for level in range(n - 1, 0, -1):
+        _leaf(lines, level + 1, 'double', n - level + 1)
+    return lines
+
+
+def many_functions_lines(n):
+    """Cue output for `n` definitions `fI <- function(a, b) return(a * b + I)`."""
+    lines = ['.level 0', '.type expression', '']
+
+    for i in range(n):
+        lines += ['.level 1', '.type language', '']
+        _leaf(lines, 2, 'symbol', '<-')
+        _leaf(lines, 2, 'symbol', 'f{}'.format(i))
+        lines += ['.level 2', '.type language', '']
+        _leaf(lines, 3, 'symbol', 'function')
+        lines += ['.level 3', '.type pairlist']
+        for name in 'ab':
+            lines += ['.argname ' + name, '.argvalue ', '.argtype symbol']
+        lines += ['']
+        lines += ['.level 3', '.type language', '']
+        _leaf(lines, 4, 'symbol', 'return')
+        lines += ['.level 4', '.type language', '']
+        _leaf(lines, 5, 'symbol', '+')
+        lines += ['.level 5', '.type language', '']
+        _leaf(lines, 6, 'symbol', '*')
+        _leaf(lines, 6, 'symbol', 'a')
+        _leaf(lines, 6, 'symbol', 'b')
+        _leaf(lines, 5, 'double', i)
+        _leaf(lines, 3, 'NULL', '')
+
+    return lines
+
+
+# Synthetic workloads for the stages benchmark, with their default sizes
+WORKLOADS = {
+    'statements': (synthetic_lines, 20000),
+    'expressions': (synthetic_expr_lines, 10000),
+    'wide_call': (wide_call_lines, 100000),
+    'deep_nesting': (deep_nesting_lines, 20000),
+    'long_chain': (long_chain_lines, 50000),
+    'many_functions': (many_functions_lines, 10000),
+}
+
+
+def walk(root):
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(reversed(node.children))
+
+
+class DictNode(object):
+
+    """The reader's node layout before nodes were slotted, for comparison."""
+
+    def __init__(self, level, type_, recs):
+        self.level = level
+        self.type = type_
+        self.recs = recs
+        self.children = []
+
+        self.content = None
+        for rec in recs:
+            if rec.name == 'content':
+                self.content = rec.value
+
+
+def node_size(node):
+    """Bytes owned by a node, not counting the strings it refers to."""
+    size = sys.getsizeof(node)
+    if hasattr(node, '__dict__'):
+        size += sys.getsizeof(node.__dict__)
+
+    size += sys.getsizeof(node.recs) + sys.getsizeof(node.children)
+    size += sum(sys.getsizeof(rec) for rec in node.recs)
+    return size
+
+
+def bench_node_memory(opts):
+    lines = synthetic_lines(int(20000 * opts.scale))
+    results = {}
+
+    for cls in (DictNode, Node):
+        nodes = list(walk(read_tree(lines, cls)))
+        total = sum(node_size(node) for node in nodes)
+        results[cls.__name__] = float(total) / len(nodes)
+        print '{:10} {:8.1f} bytes/node ({} nodes)'.format(
+            cls.__name__, results[cls.__name__], len(nodes))
+
+    return results
+
+
+def timed(f, *args):
+    start = time.time()
+    f(*args)
+    return time.time() - start
+
+
+def best(repeat, f, *args):
+    return min(timed(f, *args) for i in range(repeat))
+
+
+def bench_scan(opts):
+    # Each synthetic statement is 20 records
+    n = int(1000000 * opts.scale)
+    buf = '\n'.join(synthetic_lines(n // 20))
+
+    def regex():
+        deque(_gen_recs(buf.split('\n')), maxlen=0)
+
+    def scan():
+        deque(_scan_recs(buf), maxlen=0)
+
+    results = {}
+    for f in (regex, scan):
+        elapsed = timed(f)
+        results[f.__name__ + '_ns_per_record'] = elapsed / n * 1e9
+        print '{:10} {:8.3f}s {:8.0f} ns/record'.format(
+            f.__name__, elapsed, elapsed / n * 1e9)
+
+    return results
+
+
+def bench_transform(opts):
+    root = read_tree('\n'.join(synthetic_expr_lines(int(20000 * opts.scale))),
+                     CueGeneric)
+    count = sum(1 for node in walk(root))
+
+    elapsed = best(opts.repeat, Transformer().visit, root)
+    print '{:10} {:8.3f}s {:8.0f} ns/node ({} nodes)'.format(
+        'transform', elapsed, elapsed / count * 1e9, count)
+
+    return {'ns_per_node': elapsed / count * 1e9}
+
+
+def measure_stages(dump, repeat=3):
+    """
+    Time the reader, Transformer and Unparser separately over one cue.r
+    dump, and the three together, taking the best of `repeat` runs.
+    """
+    root = read_tree(dump, CueGeneric)
+    tree = Transformer().visit(root)
+    nodes = sum(1 for node in walk(root))
+
+    result = {
+        'nodes': nodes,
+        'bytes': len(dump),
+        'read': best(repeat, read_tree, dump, CueGeneric),
+        'transform': best(repeat, Transformer().visit, root),
+        'unparse': best(repeat, Unparser, tree, StringIO()),
+        'end_to_end': best(repeat, translate_cue_code, dump),
+    }
+    result['nodes_per_sec'] = nodes / result['end_to_end']
+    return result
+
+
+def _print_stages(name, result):
+    print '{:16} {:8} nodes {:8.3f} read {:8.3f} transform {:8.3f} unparse ' \
+          '{:8.3f} total {:10.0f} nodes/s'.format(
+              name, result['nodes'], result['read'], result['transform'],
+              result['unparse'], result['end_to_end'], result['nodes_per_sec'])
+
+
+def corpus_dumps(path):
+    """Yield (name, dump) for each saved cue.r dump in the corpus."""
+    if not os.path.isdir(path):
+        return
+
+    for name in sorted(os.listdir(path)):
+        if name.startswith('.'):
+            continue
+        with open(os.path.join(path, name), 'rb') as fh:
+            yield name, fh.read()
+
+
+def bench_stages(opts):
+    results = {}
+
+    for name in sorted(WORKLOADS):
+        make_lines, size = WORKLOADS[name]
+        dump = '\n'.join(make_lines(max(1, int(size * opts.scale))))
+        results[name] = measure_stages(dump, opts.repeat)
+        _print_stages(name, results[name])
+
+    for name, dump in corpus_dumps(opts.corpus):
+        results['corpus/' + name] = measure_stages(dump, opts.repeat)
+        _print_stages(name, results['corpus/' + name])
+
+    return results
+
+
+BENCHMARKS = {
+    'node_memory': bench_node_memory,
+    'scan': bench_scan,
+    'transform': bench_transform,
+    'stages': bench_stages,
+}
+
+
+def git_commit():
+    try:
+        p = subprocess.Popen(['git', 'describe', '--always', '--dirty'],
+                             cwd=os.path.dirname(os.path.abspath(__file__)),
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = p.communicate()
+    except OSError:
+        return None
+
+    return out.strip() or None
+
+
+def _flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.iteritems():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, prefix + key + '.'))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(old, new):
+    """Print each result next to its value in an earlier run."""
+    print 'compared with {} ({})'.format(old.get('commit'), old.get('date'))
+
+    old_flat = _flatten(old['results'])
+    new_flat = _flatten(new['results'])
+    for key in sorted(new_flat):
+        if key not in old_flat or not old_flat[key]:
+            continue
+
+        ratio = float(new_flat[key]) / old_flat[key]
+        print '{:50} {:14.6g} {:14.6g} {:8.2f}x'.format(
+            key, old_flat[key], new_flat[key], ratio)
+
+
+def record(out_dir, paths):
+    """Save cue.r's output for each R file in `paths` to `out_dir`."""
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    for path in paths:
+        with open(path, 'rb') as fh:
+            try:
+                dump = run_cue_once(fh.read())
+            except CueError as e:
+                print 'skipped {}: {}'.format(path, e)
+                continue
+
+        name = os.path.splitext(os.path.basename(path))[0] + '.cue'
+        with open(os.path.join(out_dir, name), 'wb') as fh:
+            fh.write(dump)
+        print 'recorded', name
+
+
+def main(args):
+    if args[:1] == ['record']:
+        if len(args) < 3:
+            sys.exit('usage: python bench.py record DIR FILE.r ...')
+        return record(args[1], args[2:])
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('names', nargs='*', metavar='name',
+                        help=', '.join(sorted(BENCHMARKS)))
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiply input sizes by this')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='take the best of this many runs')
+    parser.add_argument('--corpus', default=CORPUS,
+                        help='directory of saved cue.r dumps')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare with a saved JSON file')
+    opts = parser.parse_args(args)
+
+    for name in opts.names:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark: ' + name)
+
+    results = {}
+    for name in opts.names or sorted(BENCHMARKS):
+        print name
+        results[name] = BENCHMARKS[name](opts)
+
+    run = {
+        'commit': git_commit(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'scale': opts.scale,
+        'results': results,
+    }
+
+    if opts.save:
+        with open(opts.save, 'w') as fh:
+            json.dump(run, fh, indent=2, sort_keys=True)
+
+    if opts.compare:
+        with open(opts.compare) as fh:
+            compare(json.load(fh), run)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,12 +1,12 @@
-pprint <- function(...) {
-
-  convert <- function(f) {
-    if (typeof(f) == "function" || typeof(f) == "closure") {
-      f = do.call('paste0', as.list(deparse(f)))
-    }
-    return(toString(f))
+convert <- function(f) {
+  if (typeof(f) == "function" || typeof(f) == "closure") {
+    f = do.call('paste0', as.list(deparse(f)))
   }
+  return(toString(f))
+}
+
 
+pprint <- function(...) {
   args <- list(...)
   reprs <- lapply(args, convert)
   pasted <- do.call('paste', reprs)
@@ -23,39 +23,107 @@ pprint <- function(...) {
 }
 
 
+# Compact framing, selected with --format=framed. Each record is written
+# as its name without the leading '.', the length of its value in bytes,
+# and the raw value:
+#
+#   <name> <nbytes>\n<value>\n
+#
+# Values are neither escaped nor truncated, and the blank lines between
+# nodes are dropped.
+framed.print <- function(name, ...) {
+  if (name == '') {
+    return(invisible(NULL))
+  }
+
+  args <- list(...)
+  if (length(args) > 0) {
+    value <- do.call('paste', lapply(args, convert))
+  } else {
+    value <- ''
+  }
+
+  cat(substring(name, 2), ' ', nchar(value, type='bytes'), '\n',
+      value, '\n', sep='')
+}
+
+
+# The record writer used by walk() and serve()
+emit <- pprint
+
+
 level.print <- function(level, ...) {
   pad <- paste0(rep('  ', level), collapse='')
   pprint(pad, ...)
 }
 
 
-walk <- function(node, level=0) {
+# With --srcref, each top-level expression's position in the source is
+# written as ".srcref first_line first_column last_line last_column",
+# after the node's type and content.
+emit.srcref <- function(srcref) {
+  if (!is.null(srcref)) {
+    emit('.srcref', srcref[1], srcref[5], srcref[3], srcref[6])
+  }
+}
+
+
+walk <- function(node, level=0, srcref=NULL) {
   #level.print(level, typeof(node), node)
   #pprint('')
 
+  # keep.source also puts a srcref in the last element of each `function`
+  # call. Write it as the NULL that's there without keep.source.
+  if (inherits(node, 'srcref')) {
+    node <- NULL
+  }
+
   type <- typeof(node)
-  pprint('.level', level)
-  pprint('.type', type)
+  emit('.level', level)
+  emit('.type', type)
 
   if (type == "language" || type == "expression") {
-    pprint('')
-
-    # Discard the return value
-    f <- lapply(node, walk, level + 1)
+    emit.srcref(srcref)
+    emit('')
+
+    refs <- attr(node, 'srcref')
+    if (type == "expression" && !is.null(refs)) {
+      for (i in seq_along(node)) {
+        walk(node[[i]], level + 1, refs[[i]])
+      }
+    } else {
+      # Discard the return value
+      f <- lapply(node, walk, level + 1)
+    }
 
   } else if (type == "pairlist") {
 
     output_pairlist <- function(name, value) {
-      pprint('.argname', name)
-      pprint('.argvalue', value)
-      pprint('.argtype', typeof(value))
+      emit('.argname', name)
+      emit('.argvalue', value)
+      emit('.argtype', typeof(value))
     }
     mapply(output_pairlist, names(node), node)
-    pprint('')
+    emit('')
+
+    # Each argument's default value follows as a child node, so that it
+    # can be translated like any other expression. An argument without a
+    # default is written as the empty symbol.
+    for (i in seq_along(node)) {
+      if (identical(node[[i]], quote(expr=))) {
+        emit('.level', level + 1)
+        emit('.type', 'symbol')
+        emit('.content', '')
+        emit('')
+      } else {
+        walk(node[[i]], level + 1)
+      }
+    }
 
   } else {
-    pprint('.content', node)
-    pprint('')
+    emit('.content', node)
+    emit.srcref(srcref)
+    emit('')
   }
 }
 
@@ -106,8 +174,60 @@ x + 1
 #      http://www.johnmyleswhite.com/notebook/2009/12/14/object-oriented-programming-in-r-the-setter-methods/
 
 
-input <- file('stdin')
-expr <- parse(input)
-#expr <- parse(text=text)
+# Server mode: read length-prefixed source blocks from stdin and write the
+# record stream for each one, terminated by an ".end" line. Parse errors
+# (and warnings, which the one-shot mode reports on stderr) are written as
+# an ".error" record so the worker stays alive for the next block.
+#
+#   <nbytes>\n<source bytes>
+#
+serve <- function() {
+  input <- file('stdin', 'rb')
+
+  repeat {
+    header <- readLines(input, n=1)
+    if (length(header) == 0) {
+      break
+    }
+
+    n <- as.integer(header)
+    if (n > 0) {
+      text <- readChar(input, n, useBytes=TRUE)
+    } else {
+      text <- ''
+    }
+
+    tryCatch({
+      expr <- parse(text=text, keep.source=keep.srcref)
+      walk(expr)
+    }, error=function(e) {
+      emit('.error', conditionMessage(e))
+    }, warning=function(w) {
+      emit('.error', conditionMessage(w))
+    })
+
+    emit('.end')
+    flush(stdout())
+  }
+
+  close(input)
+}
+
+
+args <- commandArgs(trailingOnly=TRUE)
 
-walk(expr)
+if ('--format=framed' %in% args) {
+  emit <- framed.print
+}
+
+keep.srcref <- '--srcref' %in% args
+
+if ('--server' %in% args) {
+  serve()
+} else {
+  input <- file('stdin')
+  expr <- parse(input, keep.source=keep.srcref)
+  #expr <- parse(text=text)
+
+  walk(expr)
+}
@@ -0,0 +1,197 @@
+"""
+Incremental re-translation of R files, one top-level expression at a time.
+
+An editor integration re-translates a file after every edit. Most edits
+touch one expression, so IncrementalTranslator remembers the previous
+version of the file, split at top-level expressions, and only sends the
+text that changed to R.
+"""
+import hashlib
+from StringIO import StringIO
+
+from reader import read_tree
+from translate import (as_statement, CueError, CueGeneric, CueWorker,
+                       Transformer, run_cue)
+from unparse import Unparser
+
+
+class Segment(object):
+
+    """
+    A run of whole source lines and its translation.
+
+    A segment holds one top-level expression (or several, if they share a
+    line), preceded by any comments and blank lines before it. `parts`
+    holds the translation of each expression, as from translate_node().
+    """
+
+    __slots__ = ('source', 'parts')
+
+    def __init__(self, source, parts):
+        self.source = source
+        self.parts = parts
+
+    def __repr__(self):
+        return 'Segment({!r})'.format(self.source)
+
+
+def _lines(text):
+    """Split text into lines, keeping their newlines. Only '\\n' ends a line."""
+    lines = [line + '\n' for line in text.split('\n')]
+    if text.endswith('\n'):
+        lines.pop()
+    else:
+        lines[-1] = lines[-1][:-1]
+    return lines
+
+
+def _srcref_lines(node):
+    for rec in node.recs:
+        if rec.name == 'srcref':
+            first_line, first_col, last_line, last_col = rec.value.split()
+            return int(first_line), int(last_line)
+
+    raise CueError('no .srcref for {}; cue.r must run with --srcref'.format(node))
+
+
+def _unparse(tree):
+    out = StringIO()
+    Unparser(tree, out)
+    return out.getvalue()
+
+
+def translate_node(node):
+    """
+    Translate one top-level expression. Returns the imports it needs, such
+    as that of the promise runtime, and its code.
+    """
+    transformer = Transformer()
+    tree = as_statement(transformer.visit(node))
+    imports = [_unparse(stmt) for stmt in transformer.pending]
+    return imports, _unparse(tree)
+
+
+class IncrementalTranslator(object):
+
+    """
+    Translates successive versions of one R file, re-translating only the
+    top-level expressions that changed.
+
+    The file is split into segments of whole lines at top-level expression
+    boundaries. On each call, the segments whose text is unchanged at the
+    start and the end of the file are reused, and only the text between
+    them is parsed by R. Segments that were translated before are taken
+    from a cache keyed on the hash of their source, so only new or edited
+    expressions go through the Transformer and Unparser.
+
+    If the changed text doesn't parse on its own, for example because an
+    edit opened a brace that's closed further down, the whole file is
+    parsed again.
+    """
+
+    def __init__(self, worker=None):
+        if worker is None:
+            worker = CueWorker(srcref=True)
+
+        self.worker = worker
+        self.segments = []
+        self._cache = {}
+
+    def translate(self, source):
+        segments = self.segments
+        count = len(segments)
+
+        # Unchanged segments at the start. A segment that doesn't end in a
+        # newline was the last line of the file, so it only matches if it
+        # still is.
+        start = 0
+        pos = 0
+        while start < count:
+            seg = segments[start].source
+            if not source.startswith(seg, pos):
+                break
+            if not seg.endswith('\n') and pos + len(seg) != len(source):
+                break
+            pos += len(seg)
+            start += 1
+
+        # Unchanged segments at the end, which must start a line
+        end = count
+        stop = len(source)
+        while end > start:
+            seg = segments[end - 1].source
+            if not source.endswith(seg, pos, stop):
+                break
+            if stop - len(seg) > 0 and source[stop - len(seg) - 1] != '\n':
+                break
+            stop -= len(seg)
+            end -= 1
+
+        try:
+            changed = self._split(source[pos:stop])
+        except CueError:
+            if start == 0 and end == count:
+                raise
+            start, end = 0, count
+            changed = self._split(source)
+
+        self.segments = segments[:start] + changed + segments[end:]
+        self._cache = dict((self._key(seg.source), seg.parts)
+                           for seg in self.segments)
+
+        # Each import is written once, before the first expression that
+        # needs it, where translate() writes it
+        written = set()
+        out = []
+        for seg in self.segments:
+            for imports, code in seg.parts:
+                for stmt in imports:
+                    if stmt not in written:
+                        written.add(stmt)
+                        out.append(stmt)
+                out.append(code)
+
+        return ''.join(out)
+
+    def _key(self, source):
+        if isinstance(source, unicode):
+            source = source.encode('utf-8')
+        return hashlib.sha1(source).digest()
+
+    def _segment(self, lines, nodes):
+        source = ''.join(lines)
+        parts = self._cache.get(self._key(source))
+        if parts is None:
+            parts = [translate_node(node) for node in nodes]
+        return Segment(source, parts)
+
+    def _split(self, text):
+        """Parse text with R and split it into segments."""
+        if not text:
+            return []
+
+        cue_out = run_cue(text, self.worker)
+        root = read_tree(cue_out, CueGeneric, self.worker.format)
+        lines = _lines(text)
+
+        segments = []
+        line = 0
+        group = []
+        group_last = 0
+
+        for node in root.children:
+            first, last = _srcref_lines(node)
+
+            # srcref line numbers start at 1, so group_last is also the
+            # index of the first line after the group.
+            if group and first > group_last:
+                segments.append(self._segment(lines[line:group_last], group))
+                line = group_last
+                group = []
+
+            group.append(node)
+            group_last = max(group_last, last)
+
+        # The last segment takes any trailing comments and blank lines
+        segments.append(self._segment(lines[line:], group))
+        return segments
@@ -0,0 +1,352 @@
+"""
+Simplify translated Python before it is written out.
+
+    tree = Optimizer().optimize(Transformer().visit(node))
+
+The Optimizer folds operations on constants, such as `(60 * 60) * 24`
+and `'a' == 'b'`, drops if statements whose condition is constant down
+to the branch that runs, and drops expression statements that are only a
+constant, other than those giving a function's value in R. Folding
+follows the semantics of the generated Python (so `1 / 2` folds to 0),
+not R's, so the result behaves as the unoptimized code would have.
+"""
+import ast
+import math
+import operator
+
+
+_binops = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.div,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+}
+
+_cmpops = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+}
+
+_unaryops = {
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+    ast.Not: operator.not_,
+}
+
+# NumPy functions from NumpyTransformer that give the same result on
+# numbers as these do, within the limits checked by _fold_ufunc()
+_ufuncs = {
+    'add': operator.add,
+    'subtract': operator.sub,
+    'multiply': operator.mul,
+    'true_divide': operator.truediv,
+    'float_power': lambda x, y: float(x) ** y,
+    'positive': operator.pos,
+    'negative': operator.neg,
+}
+
+# And those that also do on booleans, where NumPy's arithmetic doesn't:
+# np.add(True, True) is True
+_ufunc_predicates = {
+    'less': operator.lt,
+    'less_equal': operator.le,
+    'greater': operator.gt,
+    'greater_equal': operator.ge,
+    'equal': operator.eq,
+    'not_equal': operator.ne,
+    'logical_not': operator.not_,
+}
+
+# NumPy's default integer, whose arithmetic wraps around
+_INT64_MIN = -2 ** 63
+_INT64_MAX = 2 ** 63 - 1
+
+# R string functions of one argument
+_string_functions = {
+    'toupper': lambda s: s.upper(),
+    'tolower': lambda s: s.lower(),
+    'nchar': len,
+}
+
+_names = {'True': True, 'False': False, 'None': None}
+
+# Don't fold to anything bigger than this, in bits or characters
+MAX_SIZE = 256
+
+
+def is_constant(node):
+    return (isinstance(node, (ast.Num, ast.Str)) or
+            isinstance(node, ast.Name) and node.id in _names)
+
+
+def constant_value(node):
+    if isinstance(node, ast.Num):
+        return node.n
+    if isinstance(node, ast.Str):
+        return node.s
+    return _names[node.id]
+
+
+def constant(value):
+    """The node for `value`, or None if it can't be written as a literal."""
+    if isinstance(value, bool) or value is None:
+        return ast.Name(repr(value), ast.Load())
+    if isinstance(value, (int, long)):
+        if abs(value).bit_length() > MAX_SIZE:
+            return None
+        return ast.Num(value)
+    if isinstance(value, float):
+        if math.isinf(value) or math.isnan(value):
+            return None
+        return ast.Num(value)
+    if isinstance(value, basestring) and len(value) <= MAX_SIZE:
+        return ast.Str(value)
+    return None
+
+
+def _is_number(value):
+    return isinstance(value, (int, long, float)) and \
+        not isinstance(value, bool)
+
+
+def _fold(func, args, numbers=True):
+    """
+    Apply `func` to the values of the constant nodes `args`, returning
+    the node for the result, or None if that can't be done safely.
+    """
+    if not all(is_constant(arg) for arg in args):
+        return None
+
+    values = [constant_value(arg) for arg in args]
+    if numbers and not all(_is_number(value) for value in values):
+        return None
+
+    # A large power is slow to compute before it's found to be too big
+    if func is operator.pow and len(values) == 2 and \
+            abs(values[1]) > MAX_SIZE:
+        return None
+
+    try:
+        return constant(func(*values))
+    except (ArithmeticError, TypeError, ValueError):
+        return None
+
+
+def _fits_int64(value):
+    return not isinstance(value, (int, long)) or \
+        _INT64_MIN <= value <= _INT64_MAX
+
+
+def _fold_ufunc(func, args, bools=False):
+    """
+    _fold() for a NumPy ufunc, or None unless Python's result is NumPy's.
+    The arguments must be numbers, or with `bools` booleans too, and
+    integers must stay within int64, where NumPy wraps around.
+    """
+    if not all(is_constant(arg) for arg in args):
+        return None
+
+    values = [constant_value(arg) for arg in args]
+    if not all((_is_number(value) or bools and isinstance(value, bool)) and
+               _fits_int64(value) for value in values):
+        return None
+
+    folded = _fold(func, args, numbers=False)
+    if isinstance(folded, ast.Num) and not _fits_int64(folded.n):
+        return None
+    return folded
+
+
+def _block(body):
+    """A statement list that can't be empty where Python needs a body."""
+    return body or [ast.Pass()]
+
+
+class Optimizer(object):
+
+    """
+    Fold constants and remove dead code from a translated Python AST.
+
+    The tree is rewritten bottom-up from an explicit stack, like the
+    Transformer, so deep expressions don't hit the recursion limit. Each
+    node is simplified after its children, so folding `1 + 2` makes a
+    constant that `(1 + 2) + 3` then folds in turn, in the one pass.
+    """
+
+    def optimize(self, tree):
+        """
+        Return the optimized `tree`: a node, a list of statements if an
+        if statement was reduced to one of its branches, or None if the
+        whole tree was a constant expression with no effect.
+        """
+        order = []
+        stack = [tree]
+        while stack:
+            node = stack.pop()
+            order.append(node)
+            for name, value in ast.iter_fields(node):
+                if isinstance(value, list):
+                    stack.extend(item for item in value
+                                 if isinstance(item, ast.AST))
+                elif isinstance(value, ast.AST):
+                    stack.append(value)
+
+        # The statements giving a function's value in R, which are kept
+        # even if they're constant: the last one, or the last ones of the
+        # branches of an if that is last
+        self._results = results = set()
+        tails = [node.body for node in order
+                 if isinstance(node, ast.FunctionDef)]
+        while tails:
+            body = tails.pop()
+            if isinstance(body, list):
+                if not body:
+                    continue
+                body = body[-1]
+            results.add(id(body))
+            if isinstance(body, ast.If):
+                tails += [body.body, body.orelse]
+
+        # Replacements by node id. Op nodes are shared between parents, and
+        # the order list keeps every node alive, so ids stay unique.
+        done = {}
+        handlers = self._handlers
+
+        for node in reversed(order):
+            for name, value in ast.iter_fields(node):
+                if isinstance(value, list):
+                    items = []
+                    for item in value:
+                        item = done.get(id(item), item)
+                        if isinstance(item, list):
+                            items.extend(item)
+                        else:
+                            items.append(item)
+                    setattr(node, name, items)
+                elif isinstance(value, ast.AST):
+                    setattr(node, name, done.get(id(value), value))
+
+            handler = handlers.get(node.__class__)
+            if handler is not None:
+                done[id(node)] = handler(self, node)
+
+        tree = done.get(id(tree), tree)
+        if isinstance(tree, ast.expr) and is_constant(tree):
+            return None
+        return tree
+
+    def _binop(self, node):
+        func = _binops.get(node.op.__class__)
+        if func is operator.add and \
+                isinstance(node.left, ast.Str) and \
+                isinstance(node.right, ast.Str):
+            folded = _fold(func, [node.left, node.right], numbers=False)
+        elif func is not None:
+            folded = _fold(func, [node.left, node.right])
+        else:
+            folded = None
+        return folded or node
+
+    def _unaryop(self, node):
+        func = _unaryops.get(node.op.__class__)
+        if func is None:
+            return node
+        folded = _fold(func, [node.operand], numbers=func is not operator.not_)
+        return folded or node
+
+    def _compare(self, node):
+        if len(node.ops) != 1:
+            return node
+
+        func = _cmpops.get(node.ops[0].__class__)
+        if func is None:
+            return node
+
+        left, right = node.left, node.comparators[0]
+        strings = isinstance(left, ast.Str) and isinstance(right, ast.Str)
+        folded = _fold(func, [left, right], numbers=not strings)
+        return folded or node
+
+    def _boolop(self, node):
+        # `and` gives its first false operand, or its last one; `or` its
+        # first true operand. Constant operands at the front decide which.
+        stop = isinstance(node.op, ast.Or)
+        values = node.values
+        while len(values) > 1 and is_constant(values[0]):
+            if bool(constant_value(values[0])) == stop:
+                return values[0]
+            values = values[1:]
+
+        if len(values) == 1:
+            return values[0]
+        node.values = values
+        return node
+
+    def _call(self, node):
+        func = node.func
+        if node.keywords or node.starargs or node.kwargs:
+            return node
+
+        if isinstance(func, ast.Attribute) and \
+                isinstance(func.value, ast.Name) and func.value.id == 'np':
+            impl = _ufuncs.get(func.attr)
+            if impl is not None:
+                return _fold_ufunc(impl, node.args) or node
+            impl = _ufunc_predicates.get(func.attr)
+            if impl is not None:
+                return _fold_ufunc(impl, node.args, bools=True) or node
+
+        elif isinstance(func, ast.Name) and len(node.args) == 1 and \
+                isinstance(node.args[0], ast.Str):
+            impl = _string_functions.get(func.id)
+            if impl is not None:
+                return _fold(impl, node.args, numbers=False) or node
+
+        return node
+
+    def _if(self, node):
+        if is_constant(node.test):
+            if constant_value(node.test):
+                branch = node.body
+            else:
+                branch = node.orelse
+            if branch is None:
+                return []
+            return branch if isinstance(branch, list) else [branch]
+
+        if not isinstance(node.body, list):
+            node.body = [node.body]
+        node.body = _block(node.body)
+        return node
+
+    def _expr(self, node):
+        # The Transformer wraps some statements as if they were expressions
+        if isinstance(node.value, (ast.stmt, list)):
+            return node.value
+        if is_constant(node.value) and id(node) not in self._results:
+            return []
+        return node
+
+    def _body(self, node):
+        node.body = _block(node.body)
+        return node
+
+    _handlers = {
+        ast.BinOp: _binop,
+        ast.UnaryOp: _unaryop,
+        ast.Compare: _compare,
+        ast.BoolOp: _boolop,
+        ast.Call: _call,
+        ast.If: _if,
+        ast.Expr: _expr,
+        ast.FunctionDef: _body,
+        ast.For: _body,
+        ast.While: _body,
+    }
@@ -0,0 +1,99 @@
+"""
+Runtime support for translated code: R's lazy default arguments.
+
+In R, a default argument is a promise. It is evaluated in the function's
+own frame, the first time the argument is used, and not at all if it never
+is:
+
+    f <- function(x, y = z * z) {
+      z <- x + 1
+      y
+    }
+
+Translated functions give such arguments the MISSING default. When the
+caller leaves one out, the function binds it to a Promise of its default
+expression, and reads of the argument go through force():
+
+    def f(x, y=MISSING):
+        if y is MISSING:
+            y = Promise(lambda: (z * z))
+        z = (x + 1)
+        force(y)
+
+The promise's closure sees the function's variables as they are when it
+is forced, as R's does, and its value is kept, so the default is computed
+at most once per call.
+"""
+
+
+class _Missing(object):
+
+    """The default of an argument whose R default is evaluated lazily."""
+
+    __slots__ = ()
+
+    def __repr__(self):
+        return 'MISSING'
+
+    def __reduce__(self):
+        return 'MISSING'
+
+
+MISSING = _Missing()
+
+
+# Marks a promise whose value is being computed
+_FORCING = object()
+
+
+class Promise(object):
+
+    """
+    A value computed by `thunk` when it's first needed, then kept.
+
+    Forcing a promise from within its own thunk, as a default that refers
+    to its own argument would, raises RuntimeError, as R stops with an
+    error. If the thunk raises, the promise is left unforced, and forcing
+    it again runs the thunk again.
+    """
+
+    __slots__ = ('_thunk', '_value')
+
+    def __init__(self, thunk):
+        self._thunk = thunk
+
+    @property
+    def forced(self):
+        return self._thunk is None
+
+    def force(self):
+        thunk = self._thunk
+        if thunk is None:
+            return self._value
+        if thunk is _FORCING:
+            raise RuntimeError(
+                'promise already under evaluation: recursive default '
+                'argument reference')
+
+        self._thunk = _FORCING
+        try:
+            value = thunk()
+        except BaseException:
+            self._thunk = thunk
+            raise
+
+        self._value = value
+        self._thunk = None
+        return value
+
+    def __repr__(self):
+        if self._thunk is None:
+            return '<Promise {!r}>'.format(self._value)
+        return '<Promise unforced>'
+
+
+def force(value):
+    """The value of `value`: forced if it's a Promise, else itself."""
+    if type(value) is Promise:
+        return value.force()
+    return value
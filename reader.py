@@ -1,5 +1,8 @@
-from collections import namedtuple
-from itertools import tee
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from itertools import islice
+import mmap
+import os
 import re
 
 from more_itertools import peekable
@@ -17,7 +20,112 @@ def _gen_recs(lines):
             if not m:
                 raise ParseError(line)
             else:
-                yield Rec._make(m.groups())
+                name, value = m.groups()
+                yield Rec(intern(name), value)
+
+
+def _scan_recs(buf):
+    """
+    Scan cue.r's text output held in a single string, without splitting it
+    into lines or running a regex per line. Yields the same records, and
+    raises the same ParseError, as _gen_recs.
+
+    cue.r escapes whitespace inside values, so the name always ends at the
+    first space.
+    """
+    find = buf.find
+    new_rec = tuple.__new__
+
+    pos = 0
+    end = len(buf)
+
+    while pos < end:
+        eol = find('\n', pos)
+        if eol == -1:
+            eol = end
+
+        if buf[pos:pos + 1] == '.':
+            line = buf[pos:eol].strip()
+            sep = line.find(' ', 2)
+
+            if sep != -1:
+                yield new_rec(Rec, (intern(line[1:sep]), line[sep + 1:]))
+            elif len(line) > 1:
+                yield new_rec(Rec, (intern(line[1:]), None))
+            else:
+                raise ParseError(buf[pos:eol])
+
+        pos = eol + 1
+
+
+# Lines joined for each _scan_recs call when reading a sequence of lines
+SCAN_LINES = 256
+
+def _scan_lines(lines):
+    """
+    _scan_recs over a sequence of lines, such as CueWorker.stream() yields,
+    a few hundred lines at a time. Scanning each line on its own would cost
+    as much as the regex.
+    """
+    lines = iter(lines)
+    while True:
+        batch = list(islice(lines, SCAN_LINES))
+        if not batch:
+            return
+
+        # Lines from a file or a worker keep their newlines; others, such
+        # as a list of lines, may not
+        sep = '' if batch[0].endswith('\n') else '\n'
+        for rec in _scan_recs(sep.join(batch)):
+            yield rec
+
+
+def _gen_text_recs(lines):
+    if isinstance(lines, (basestring, mmap.mmap)):
+        return _scan_recs(lines)
+    return _scan_lines(lines)
+
+
+def _gen_framed_recs(buf):
+    """
+    Parse cue.r's --format=framed output: each record is a header line
+    "<name> <nbytes>" followed by exactly that many bytes of value and a
+    newline. An empty value reads as None, as it does in the text format.
+
+    `buf` is the whole output as a string or mmap, or an iterable of
+    strings that each hold whole records, as CueWorker.stream() yields.
+    """
+    if not isinstance(buf, (basestring, mmap.mmap)):
+        return (rec for chunk in buf for rec in _scan_framed(chunk))
+    return _scan_framed(buf)
+
+
+def _scan_framed(buf):
+    pos = 0
+    end = len(buf)
+
+    while pos < end:
+        eol = buf.find('\n', pos)
+        if eol == -1:
+            raise ParseError(buf[pos:])
+
+        name, sep, size = buf[pos:eol].partition(' ')
+        if not sep or not size.isdigit():
+            raise ParseError(buf[pos:eol])
+
+        start = eol + 1
+        pos = start + int(size)
+        if buf[pos:pos + 1] != '\n':
+            raise ParseError(buf[start:pos])
+
+        yield Rec(intern(name), buf[start:pos] or None)
+        pos += 1
+
+
+_rec_formats = {
+    'text': _gen_text_recs,
+    'framed': _gen_framed_recs,
+}
 
 
 def _group_recs(recs):
@@ -46,7 +154,7 @@ def _convert(groups, Node):
 
         type_rec = group[1]
         assert type_rec.name == 'type', 'expected .type: {}'.format(type_rec)
-        type_ = type_rec.value
+        type_ = intern(type_rec.value)
 
         node = Node(level, type_, group[2:])
 
@@ -54,41 +162,119 @@ def _convert(groups, Node):
         
 
 class Node(object):
+
+    """
+    A node in the tree of cue records.
+
+    Nodes are slotted, and their type and record names are interned, to
+    keep allocation down on large record streams. The target is at most
+    300 bytes per node on 64-bit CPython 2.7, not counting the content
+    strings, against ~550 for a __dict__ based node
+    (see `python bench.py node_memory`).
+    """
+
+    __slots__ = ('level', 'type', 'recs', 'children', 'content')
+
     def __init__(self, level, type_, recs):
         self.level = level
         self.type = type_
         self.recs = recs
         self.children = []
 
+        # cue.r writes a leaf's value as its first record
+        if recs and recs[0].name == 'content':
+            self.content = recs[0].value
+        else:
+            self.content = None
+
     def __repr__(self):
         return 'Node({}, {})'.format(self.level, self.type)
 
 
-def _build_tree(nodes, parent):
-    try:
-        while nodes.peek().level > parent.level:
-            if nodes.peek().level == parent.level + 1:
-                node = nodes.next()
-                parent.children.append(node)
-            else:
-                _build_tree(nodes, node)
+def _nodes(lines, Node, format):
+    recs = _rec_formats[format](lines)
+    groups = _group_recs(recs)
+    return _convert(groups, Node)
 
-    except StopIteration:
-        pass
 
+def reader(lines, Node=Node, format='text'):
+    """
+    Yield nodes in document order, attaching each to its parent as it
+    arrives.
 
-def reader(lines, Node=Node):
-    recs = _gen_recs(lines)
-    groups = _group_recs(recs)
-    nodes = _convert(groups, Node)
+    `lines` is a sequence of lines of cue.r's default text output, or the
+    whole output as one string or mmap (see map_file). The 'framed' format
+    is read from a string or mmap, or from a sequence of whole records.
+
+    A node's children are complete once the generator has moved past its
+    subtree. Parents are tracked on an explicit stack, so nesting depth is
+    not limited by Python's recursion limit.
+    """
+    stack = []
+
+    for node in _nodes(lines, Node, format):
+        while stack and stack[-1].level >= node.level:
+            stack.pop()
+
+        if stack:
+            stack[-1].children.append(node)
+
+        stack.append(node)
+        yield node
+
+
+def read_tree(lines, Node=Node, format='text'):
+    """Read every node and return the root."""
+    nodes = reader(lines, Node, format)
+    root = nodes.next()
+    deque(nodes, maxlen=0)
+    return root
+
+
+def read_subtrees(lines, Node=Node, level=1, format='text'):
+    """
+    Yield each node at `level` as soon as its subtree is complete.
+
+    The yielded nodes are not attached to their parents, so a caller that
+    drops each subtree after handling it keeps memory bounded by the size
+    of one subtree rather than the whole tree.
+    """
+    stack = []
+
+    for node in _nodes(lines, Node, format):
+        while stack and stack[-1].level >= node.level:
+            done = stack.pop()
+            if done.level == level:
+                yield done
+
+        if stack and node.level != level:
+            stack[-1].children.append(node)
+
+        stack.append(node)
+
+    while stack:
+        done = stack.pop()
+        if done.level == level:
+            yield done
 
-    nodes_a, nodes_b = tee(nodes)
 
-    root = nodes_a.next()
-    nodes_a = peekable(nodes_a)
-    _build_tree(nodes_a, root)
+@contextmanager
+def map_file(path):
+    """
+    Memory-map a saved cue.r dump, for reading without first loading the
+    whole file into a string.
+    """
+    with open(path, 'rb') as fh:
+        # mmap refuses empty files
+        if os.fstat(fh.fileno()).st_size == 0:
+            yield ''
+            return
 
-    return nodes_b
+        buf = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield buf
+        finally:
+            buf.close()
 
 
 def print_tree(root):
@@ -0,0 +1,1008 @@
+"""
+An R parser in Python, producing what cue.r writes for R's own parse().
+
+translate() needs R only to parse the source and walk the result with
+cue.r. This module does both in process, so translation doesn't need R
+installed and doesn't pay for a subprocess:
+
+    from rparse import ParserWorker
+    translate('x <- 1', ParserWorker())
+
+ParserWorker stands in for translate.CueWorker. It writes the same record
+streams, in either format, and can be used anywhere a CueWorker can.
+
+The parser follows R's grammar (see ?Syntax and R's gram.y): operator
+precedence and associativity, newlines ending expressions except inside
+parentheses and brackets or after an incomplete expression, `->`
+assignment, `**` as `^`, `|>` pipes and `\\(x)` lambdas. Values are
+formatted as R's as.character() would format them, so that the records
+match cue.r's. Default argument values that are calls are written the way
+as.character() deparses them, which this only approximates for unusual
+code.
+"""
+import hashlib
+import math
+import os
+import re
+
+from reader import Rec
+from translate import CueError
+
+
+class RSyntaxError(CueError): pass
+
+
+class _Value(object):
+
+    __slots__ = ()
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(
+            getattr(self, name) == getattr(other, name)
+            for name in self.__slots__)
+
+    def __ne__(self, other):
+        return not self == other
+
+
+class Sym(_Value):
+
+    """An R symbol. The empty symbol stands for a missing argument."""
+
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return 'Sym({!r})'.format(self.name)
+
+
+class Const(_Value):
+
+    """
+    An R constant: its typeof() and its value as as.character() writes it,
+    or None for NULL.
+    """
+
+    __slots__ = ('type', 'value')
+
+    def __init__(self, type_, value):
+        self.type = type_
+        self.value = value
+
+    def __repr__(self):
+        return 'Const({!r}, {!r})'.format(self.type, self.value)
+
+
+class Call(_Value):
+
+    """An R call: the function followed by its arguments, names dropped."""
+
+    __slots__ = ('items',)
+
+    def __init__(self, items):
+        self.items = items
+
+    def __repr__(self):
+        return 'Call({!r})'.format(self.items)
+
+
+class Formals(_Value):
+
+    """A function's formal arguments: (name, default) pairs."""
+
+    __slots__ = ('args',)
+
+    def __init__(self, args):
+        self.args = args
+
+
+NULL = Const('NULL', None)
+MISSING = Sym('')
+
+
+def typeof(obj):
+    if isinstance(obj, Sym):
+        return 'symbol'
+    elif isinstance(obj, Call):
+        return 'language'
+    elif isinstance(obj, Formals):
+        return 'pairlist'
+    return obj.type
+
+
+# Formatting values as R does
+
+def format_double(x):
+    """
+    Format a double as as.character() does: at most 15 significant
+    digits, as few as represent the value, and in scientific notation
+    when that's shorter than fixed notation.
+    """
+    if math.isnan(x):
+        return 'NaN'
+    if math.isinf(x):
+        return 'Inf' if x > 0 else '-Inf'
+    if x == 0:
+        return '0'
+
+    target = float('%.15g' % x)
+    for digits in range(1, 16):
+        sci = '%.*e' % (digits - 1, x)
+        if float(sci) == target:
+            break
+
+    mantissa, exponent = sci.split('e')
+    exponent = int(exponent)
+    sci = '{}e{}{:02d}'.format(mantissa, '-' if exponent < 0 else '+',
+                               abs(exponent))
+    fixed = '%.*f' % (max(0, digits - 1 - exponent), x)
+
+    return fixed if len(fixed) <= len(sci) else sci
+
+
+_escapes = {
+    u'\\': u'\\\\', u'\a': u'\\a', u'\b': u'\\b', u'\f': u'\\f',
+    u'\n': u'\\n', u'\r': u'\\r', u'\t': u'\\t', u'\v': u'\\v',
+}
+
+def encode_string(text):
+    """R's encodeString(text), for unicode text: escape what isn't printable."""
+    out = []
+    for c in text:
+        if c in _escapes:
+            out.append(_escapes[c])
+        elif c < u' ' or c == u'\x7f':
+            out.append(u'\\{:03o}'.format(ord(c)))
+        else:
+            out.append(c)
+    return u''.join(out)
+
+
+def deparse(obj):
+    """An approximation of deparse(), for default argument values."""
+    if isinstance(obj, Sym):
+        return obj.name
+    elif isinstance(obj, Const):
+        if obj.type == 'character':
+            value = encode_string(obj.value.decode('utf-8'))
+            return u'"{}"'.format(value.replace(u'"', u'\\"')).encode('utf-8')
+        elif obj.type == 'integer':
+            return obj.value + 'L'
+        elif obj.type == 'NULL':
+            return 'NULL'
+        return obj.value
+    elif isinstance(obj, Formals):
+        return ', '.join(name if default is MISSING
+                         else '{} = {}'.format(name, deparse(default))
+                         for name, default in obj.args)
+
+    items = obj.items
+    head = items[0]
+    args = [deparse(item) for item in items[1:]]
+    name = head.name if isinstance(head, Sym) else None
+
+    if name in _tight_binary and len(args) == 2:
+        return '{}{}{}'.format(args[0], name, args[1])
+    elif (name in _binary or name and name[0] == '%') and len(args) == 2:
+        return '{} {} {}'.format(args[0], name, args[1])
+    elif name in _unary and len(args) == 1:
+        return name + args[0]
+    elif name == '(' and len(args) == 1:
+        return '({})'.format(args[0])
+    elif name == '{':
+        return '{' + '; '.join(args) + '}'
+    elif name == '[' and args:
+        return '{}[{}]'.format(args[0], ', '.join(args[1:]))
+    elif name == '[[' and args:
+        return '{}[[{}]]'.format(args[0], ', '.join(args[1:]))
+    elif name == 'if' and len(args) in (2, 3):
+        text = 'if ({}) {}'.format(args[0], args[1])
+        if len(args) == 3:
+            text += ' else ' + args[2]
+        return text
+    elif name == 'for' and len(args) == 3:
+        return 'for ({} in {}) {}'.format(*args)
+    elif name == 'while' and len(args) == 2:
+        return 'while ({}) {}'.format(*args)
+    elif name == 'repeat' and len(args) == 1:
+        return 'repeat ' + args[0]
+    elif name == 'function' and len(args) >= 2:
+        return 'function({}) {}'.format(args[0], args[1])
+    elif name in ('break', 'next') and not args:
+        return name
+
+    return '{}({})'.format(deparse(head), ', '.join(args))
+
+
+def as_character(obj):
+    """toString(obj), as cue.r's convert() writes a value."""
+    if isinstance(obj, Sym):
+        return obj.name
+    elif isinstance(obj, Const):
+        return obj.value or ''
+    elif isinstance(obj, Call):
+        # as.character() on a call deparses each element separately
+        return ', '.join(as_character(item) if not isinstance(item, Call)
+                         else deparse(item) for item in obj.items)
+    return deparse(obj)
+
+
+# Lexing
+
+_tight_binary = frozenset(['^', ':', '$', '@', '::', ':::'])
+_binary = frozenset(['+', '-', '*', '/', '<', '>', '<=', '>=', '==', '!=',
+                     '&', '&&', '|', '||', '<-', '<<-', '->', '->>', '=',
+                     '~', '?', ':='])
+_unary = frozenset(['-', '+', '!', '~', '?'])
+
+_keywords = {
+    'TRUE': Const('logical', 'TRUE'),
+    'FALSE': Const('logical', 'FALSE'),
+    'NULL': NULL,
+    'NA': Const('logical', 'NA'),
+    'NA_integer_': Const('integer', 'NA'),
+    'NA_real_': Const('double', 'NA'),
+    'NA_character_': Const('character', 'NA'),
+    'NA_complex_': Const('complex', 'NA'),
+    'Inf': Const('double', 'Inf'),
+    'NaN': Const('double', 'NaN'),
+}
+
+_reserved = frozenset(['if', 'else', 'repeat', 'while', 'function', 'for',
+                       'in', 'next', 'break'])
+
+# Longest first, so that '<<-' isn't read as '<' '<-'
+_operators = sorted([
+    '<<-', '->>', ':::', '::', '<-', '->', '<=', '>=', '==', '!=', '&&',
+    '||', '|>', '**', ':=', '[[', '+', '-', '*', '/', '^', '<', '>', '!',
+    '&', '|', '~', '?', ':', '=', '$', '@', '(', ')', '{', '}', '[', ']',
+    ',', ';', '\\',
+], key=len, reverse=True)
+
+_token_rx = re.compile(ur'''
+    (?P<space>[ \t\r\f\v]+|\#[^\n]*)
+  | (?P<newline>\n)
+  | (?P<number>(?:0[xX][0-9a-fA-F]+|(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][+-]?[0-9]+)?)[Li]?)
+  | (?P<raw>[rR](?P<rq>["'])(?P<dashes>-*)(?P<open>[\(\[\{]))
+  | (?P<string>["'])
+  | (?P<name>(?:[^\W\d_]|\.(?![0-9]))[\w.]*|\.)
+  | (?P<backtick>`)
+  | (?P<special>%[^%\n]*%)
+  | (?P<op>''' + u'|'.join(re.escape(op) for op in _operators) + ur''')
+''', re.VERBOSE | re.UNICODE)
+
+_string_escapes = {
+    u'n': u'\n', u't': u'\t', u'r': u'\r', u'0': None, u'a': u'\a',
+    u'b': u'\b', u'f': u'\f', u'v': u'\v', u'\\': u'\\', u'"': u'"',
+    u"'": u"'", u'`': u'`', u' ': u' ', u'\n': u'\n',
+}
+
+_closers = {u'(': u')', u'[': u']', u'{': u'}'}
+
+
+class Token(object):
+
+    __slots__ = ('kind', 'value', 'line', 'col', 'end_line', 'end_col')
+
+    def __init__(self, kind, value, line, col, end_line, end_col):
+        self.kind = kind
+        self.value = value
+        self.line = line
+        self.col = col
+        self.end_line = end_line
+        self.end_col = end_col
+
+    def __repr__(self):
+        return 'Token({}, {!r})'.format(self.kind, self.value)
+
+    def describe(self):
+        if self.kind == 'eof':
+            return 'end of input'
+        elif self.kind == 'newline':
+            return 'end of line'
+        elif self.kind == 'op':
+            return "'{}'".format(self.value)
+        elif self.kind == 'num':
+            return 'numeric constant'
+        elif self.kind == 'str':
+            return 'string constant'
+        return 'symbol'
+
+
+def _number(text):
+    suffix = text[-1]
+    if suffix in 'Li':
+        text = text[:-1]
+
+    if text[:2] in ('0x', '0X'):
+        value = float(int(text, 16))
+    else:
+        value = float(text)
+
+    if suffix == 'i':
+        return Const('complex', '0+{}i'.format(format_double(value)))
+    if suffix == 'L' and value == int(value) and abs(value) < 2 ** 31:
+        return Const('integer', str(int(value)))
+    return Const('double', format_double(value))
+
+
+class Lexer(object):
+
+    def __init__(self, text):
+        self.text = text
+        self.pos = 0
+        self.line = 1
+        self.line_start = 0
+
+    def error(self, message):
+        raise RSyntaxError('{}:{}: {}'.format(
+            self.line, self.pos - self.line_start + 1, message))
+
+    def _advance(self, end):
+        text = self.text
+        newlines = text.count(u'\n', self.pos, end)
+        if newlines:
+            self.line += newlines
+            self.line_start = text.rindex(u'\n', self.pos, end) + 1
+        self.pos = end
+
+    def _string(self, quote):
+        """Read a quoted string or backtick name, after its opening quote."""
+        text = self.text
+        out = []
+        pos = self.pos
+
+        while True:
+            end = pos
+            while end < len(text) and text[end] not in (quote, u'\\'):
+                end += 1
+            out.append(text[pos:end])
+
+            if end >= len(text):
+                self._advance(end)
+                self.error('unexpected INCOMPLETE_STRING')
+
+            if text[end] == quote:
+                self._advance(end + 1)
+                return u''.join(out)
+
+            pos = end + 1
+            c = text[pos:pos + 1]
+            if c in _string_escapes and _string_escapes[c] is not None:
+                out.append(_string_escapes[c])
+                pos += 1
+                continue
+
+            m = (re.match(ur'x([0-9a-fA-F]{1,2})', text[pos:pos + 3])
+                 or re.match(ur'([0-7]{1,3})', text[pos:pos + 3]))
+            if m:
+                base = 16 if c == u'x' else 8
+                code = int(m.group(1), base)
+                if code == 0:
+                    self._advance(pos)
+                    self.error('nul character not allowed')
+                out.append(unichr(code))
+                pos += m.end()
+                continue
+
+            m = (re.match(ur'u\{([0-9a-fA-F]{1,4})\}|u([0-9a-fA-F]{1,4})',
+                          text[pos:pos + 7])
+                 or re.match(ur'U\{([0-9a-fA-F]{1,8})\}|U([0-9a-fA-F]{1,8})',
+                             text[pos:pos + 11]))
+            if m:
+                out.append(_unichr(int(m.group(1) or m.group(2), 16)))
+                pos += m.end()
+                continue
+
+            self._advance(pos)
+            self.error("'\\{}' is an unrecognized escape".format(
+                c.encode('utf-8')))
+
+    def _raw_string(self, quote, dashes, open_):
+        close = _closers[open_] + dashes + quote
+        end = self.text.find(close, self.pos)
+        if end == -1:
+            self._advance(len(self.text))
+            self.error('malformed raw string literal')
+
+        value = self.text[self.pos:end]
+        self._advance(end + len(close))
+        return value
+
+    def _word(self, kind, text):
+        """The (kind, value) of a number, name or operator token."""
+        if kind == 'number':
+            return 'num', _number(text)
+
+        text = text.encode('utf-8')
+        if kind == 'name':
+            if text in _keywords:
+                return 'num', _keywords[text]
+            elif text in _reserved:
+                return 'op', text
+            return 'sym', Sym(text)
+        elif text == '**':
+            return 'op', '^'
+        return 'op', text
+
+    def tokens(self):
+        text = self.text
+        end = len(text)
+        match = _token_rx.match
+
+        # Tokens that aren't strings are looked up once per distinct text;
+        # the Sym and Const objects they carry are never modified
+        words = {}
+
+        while self.pos < end:
+            pos = self.pos
+            m = match(text, pos)
+            if m is None:
+                self.error(u'unexpected input {!r}'.format(text[pos]))
+
+            kind = m.lastgroup
+            line = self.line
+            col = pos - self.line_start + 1
+            self.pos = m.end()
+
+            if kind == 'space':
+                continue
+            elif kind == 'newline':
+                self.line += 1
+                self.line_start = self.pos
+                yield Token('newline', None, line, col, line, col)
+                continue
+            elif kind == 'string':
+                value = self._string(m.group())
+                kind, value = 'str', Const('character', value.encode('utf-8'))
+            elif kind == 'raw':
+                value = self._raw_string(m.group('rq'), m.group('dashes'),
+                                         m.group('open'))
+                kind, value = 'str', Const('character', value.encode('utf-8'))
+            elif kind == 'backtick':
+                kind, value = 'sym', Sym(self._string(u'`').encode('utf-8'))
+            else:
+                word = m.group()
+                try:
+                    kind, value = words[word]
+                except KeyError:
+                    kind, value = words[word] = self._word(kind, word)
+
+            yield Token(kind, value, line, col, self.line,
+                        self.pos - self.line_start)
+
+        col = self.pos - self.line_start + 1
+        yield Token('eof', None, self.line, col, self.line, col)
+
+
+def _unichr(code):
+    try:
+        return unichr(code)
+    except ValueError:
+        # A narrow build: write the surrogate pair
+        code -= 0x10000
+        return unichr(0xd800 + (code >> 10)) + unichr(0xdc00 + (code & 0x3ff))
+
+
+# Parsing
+
+# Binary operator precedence, from R's gram.y, lowest first, and whether
+# each group is left associative. Comparisons don't associate at all.
+_precedence = [
+    (['?'], 'left'),
+    (['='], 'right'),
+    (['<-', '<<-', ':='], 'right'),
+    (['->', '->>'], 'left'),
+    (['~'], 'left'),
+    (['||', '|'], 'left'),
+    (['&&', '&'], 'left'),
+    ([], 'unary !'),
+    (['<', '>', '<=', '>=', '==', '!='], 'none'),
+    (['+', '-'], 'left'),
+    (['*', '/'], 'left'),
+    (['%%', '|>'], 'left'),
+    ([':'], 'left'),
+    ([], 'unary + -'),
+    (['^'], 'right'),
+    (['$', '@'], 'left'),
+]
+
+_binary_ops = {}
+for _level, (_ops, _assoc) in enumerate(_precedence, 1):
+    for _op in _ops:
+        _binary_ops[_op] = (_level, _assoc)
+
+HELP, EQ_ASSIGN, LEFT_ASSIGN = 1, 2, 3
+TILDE = _binary_ops['~'][0]
+NOT = 8
+UNARY = 14
+POSTFIX = len(_precedence) + 1
+
+_right_assign = {'->': '<-', '->>': '<<-'}
+
+
+class Parser(object):
+
+    """
+    A precedence climbing parser over the Lexer's tokens.
+
+    Newlines are dropped where R ignores them: inside parentheses and
+    brackets, and wherever an expression is incomplete. Elsewhere a
+    newline ends the expression.
+    """
+
+    def __init__(self, text):
+        if isinstance(text, str):
+            try:
+                text = text.decode('utf-8')
+            except UnicodeDecodeError as e:
+                raise RSyntaxError('invalid UTF-8 in source: {}'.format(e))
+        if text.startswith(u'\ufeff'):
+            text = text[1:]
+
+        self.tokens = list(Lexer(text).tokens())
+        self.pos = 0
+        # Whether newlines are ignored, innermost bracket last
+        self.nl_ignored = [False]
+
+    def peek(self):
+        tokens = self.tokens
+        pos = self.pos
+        if self.nl_ignored[-1]:
+            while tokens[pos].kind == 'newline':
+                pos += 1
+            self.pos = pos
+        return tokens[pos]
+
+    def skip_newlines(self):
+        while self.tokens[self.pos].kind == 'newline':
+            self.pos += 1
+
+    def next(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def error(self, token):
+        raise RSyntaxError('{}:{}: unexpected {}'.format(
+            token.line, token.col, token.describe()))
+
+    def is_op(self, token, *values):
+        return token.kind == 'op' and token.value in values
+
+    def expect(self, value):
+        token = self.next()
+        if not self.is_op(token, value):
+            self.error(token)
+        return token
+
+    def bracketed(self, ignore_newlines, parse):
+        self.nl_ignored.append(ignore_newlines)
+        try:
+            return parse()
+        finally:
+            self.nl_ignored.pop()
+
+    def parse_program(self):
+        """Parse the top-level expressions, with their source positions."""
+        exprs = []
+        while True:
+            self.skip_newlines()
+            token = self.peek()
+            if token.kind == 'eof':
+                return exprs
+            if self.is_op(token, ';'):
+                self.pos += 1
+                continue
+
+            first = self.peek()
+            expr = self.parse_expr(HELP)
+            last = self.tokens[self.pos - 1]
+            exprs.append((expr, (first.line, first.col,
+                                 last.end_line, last.end_col)))
+
+            token = self.peek()
+            if token.kind not in ('newline', 'eof') and not self.is_op(token, ';'):
+                self.error(token)
+
+    def parse_expr(self, min_level):
+        left = self.parse_prefix()
+        nonassoc = None
+
+        while True:
+            token = self.peek()
+            if token.kind != 'op':
+                return left
+
+            op = token.value
+            if op in ('(', '[', '[['):
+                left = self.parse_postfix(left, op)
+                continue
+
+            if op.startswith('%'):
+                level, assoc = _binary_ops['%%']
+            elif op in _binary_ops:
+                level, assoc = _binary_ops[op]
+            else:
+                return left
+
+            if level < min_level:
+                return left
+            if level == nonassoc:
+                self.error(token)
+
+            self.pos += 1
+            if op in ('$', '@'):
+                left = Call([Sym(op), left, self.parse_name()])
+                continue
+
+            self.skip_newlines()
+            right = self.parse_expr(level + 1 if assoc != 'right' else level)
+
+            if op in _right_assign:
+                left = Call([Sym(_right_assign[op]), right, left])
+            elif op == '|>':
+                left = self.pipe(left, right, token)
+            else:
+                left = Call([Sym(op), left, right])
+
+            nonassoc = level if assoc == 'none' else None
+
+    def pipe(self, left, right, token):
+        if not isinstance(right, Call):
+            raise RSyntaxError('{}:{}: The pipe operator requires a function '
+                               'call as RHS'.format(token.line, token.col))
+        return Call([right.items[0], left] + right.items[1:])
+
+    def parse_name(self):
+        """The right-hand side of `$` or `@`."""
+        token = self.next()
+        if token.kind == 'sym' or (token.kind == 'str'):
+            return token.value
+        if token.kind == 'op' and token.value in _reserved:
+            return Sym(token.value)
+        self.error(token)
+
+    def parse_prefix(self):
+        self.skip_newlines()
+        token = self.next()
+        kind, value = token.kind, token.value
+
+        if kind == 'num':
+            return value
+        elif kind in ('sym', 'str'):
+            following = self.tokens[self.pos]
+            if self.is_op(following, '::', ':::'):
+                self.pos += 1
+                name = self.next()
+                if name.kind not in ('sym', 'str'):
+                    self.error(name)
+                return Call([Sym(following.value), value, name.value])
+            return value
+        elif kind != 'op':
+            self.error(token)
+
+        if value in ('-', '+'):
+            return Call([Sym(value), self.parse_expr(UNARY)])
+        elif value == '!':
+            return Call([Sym(value), self.parse_expr(NOT)])
+        elif value == '~':
+            return Call([Sym(value), self.parse_expr(TILDE + 1)])
+        elif value == '?':
+            return Call([Sym(value), self.parse_expr(HELP + 1)])
+        elif value == '(':
+            expr = self.bracketed(True, lambda: self.parse_expr(HELP))
+            self.expect(')')
+            return Call([Sym('('), expr])
+        elif value == '{':
+            return self.parse_block()
+        elif value == 'if':
+            return self.parse_if()
+        elif value == 'for':
+            return self.parse_for()
+        elif value == 'while':
+            cond = self.parse_condition()
+            return Call([Sym('while'), cond, self.parse_body()])
+        elif value == 'repeat':
+            return Call([Sym('repeat'), self.parse_body()])
+        elif value in ('function', '\\'):
+            return self.parse_function()
+        elif value in ('break', 'next'):
+            return Call([Sym(value)])
+
+        self.error(token)
+
+    def parse_body(self):
+        return self.parse_expr(EQ_ASSIGN)
+
+    def parse_condition(self):
+        self.expect('(')
+        cond = self.bracketed(True, lambda: self.parse_expr(HELP))
+        self.expect(')')
+        return cond
+
+    def parse_block(self):
+        def statements():
+            exprs = []
+            while True:
+                self.skip_newlines()
+                token = self.peek()
+                if self.is_op(token, '}'):
+                    return exprs
+                if self.is_op(token, ';'):
+                    self.pos += 1
+                    continue
+
+                exprs.append(self.parse_expr(HELP))
+                token = self.peek()
+                if not (token.kind == 'newline' or self.is_op(token, ';', '}')):
+                    self.error(token)
+
+        exprs = self.bracketed(False, statements)
+        self.expect('}')
+        return Call([Sym('{')] + exprs)
+
+    def parse_if(self):
+        cond = self.parse_condition()
+        body = self.parse_body()
+
+        # Inside braces, `else` may start the next line
+        pos = self.pos
+        if not self.nl_ignored[-1] and len(self.nl_ignored) > 1:
+            self.skip_newlines()
+
+        if self.is_op(self.peek(), 'else'):
+            self.pos += 1
+            return Call([Sym('if'), cond, body, self.parse_body()])
+
+        self.pos = pos
+        return Call([Sym('if'), cond, body])
+
+    def parse_for(self):
+        def header():
+            var = self.next()
+            if var.kind != 'sym':
+                self.error(var)
+            self.expect('in')
+            return var.value, self.parse_expr(HELP)
+
+        self.expect('(')
+        var, seq = self.bracketed(True, header)
+        self.expect(')')
+        return Call([Sym('for'), var, seq, self.parse_body()])
+
+    def parse_function(self):
+        def formals():
+            args = []
+            names = set()
+            while True:
+                token = self.next()
+                if self.is_op(token, ')') and not args:
+                    return args
+                if token.kind != 'sym':
+                    self.error(token)
+
+                name = token.value.name
+                if name in names:
+                    raise RSyntaxError(
+                        '{}:{}: repeated formal argument \'{}\''.format(
+                            token.line, token.col, name))
+                names.add(name)
+
+                default = MISSING
+                if self.is_op(self.peek(), '='):
+                    self.pos += 1
+                    default = self.parse_expr(LEFT_ASSIGN)
+                args.append((name, default))
+
+                token = self.next()
+                if self.is_op(token, ')'):
+                    return args
+                if not self.is_op(token, ','):
+                    self.error(token)
+
+        self.expect('(')
+        args = self.bracketed(True, formals)
+        formals = Formals(args) if args else NULL
+        return Call([Sym('function'), formals, self.parse_body(), NULL])
+
+    def parse_postfix(self, left, op):
+        self.pos += 1
+        close = ')' if op == '(' else ']'
+        args = self.bracketed(True, lambda: self.parse_args(close))
+
+        self.expect(close)
+        if op == '[[':
+            self.expect(']')
+
+        if op == '(':
+            # f() has no arguments, rather than one missing one
+            if args == [MISSING]:
+                args = []
+            if isinstance(left, Const) and left.type == 'character':
+                left = Sym(left.value)
+            return Call([left] + args)
+
+        return Call([Sym(op), left] + args)
+
+    def parse_args(self, close):
+        args = []
+        while True:
+            token = self.peek()
+            if self.is_op(token, ',', close):
+                args.append(MISSING)
+            else:
+                # name = value: the names aren't kept
+                if (token.kind in ('sym', 'str') or token.value is NULL) and \
+                        self.is_op(self.tokens[self.pos + 1], '='):
+                    self.pos += 2
+                    if self.is_op(self.peek(), ',', close):
+                        args.append(MISSING)
+                    else:
+                        args.append(self.parse_expr(LEFT_ASSIGN))
+                else:
+                    args.append(self.parse_expr(LEFT_ASSIGN))
+
+            token = self.peek()
+            if self.is_op(token, close):
+                return args
+            if not self.is_op(token, ','):
+                self.error(token)
+            self.pos += 1
+
+
+def parse(text):
+    """
+    Parse R source into a list of (expression, srcref) pairs, where srcref
+    is (first_line, first_column, last_line, last_column).
+
+    Raises RSyntaxError, a CueError, for invalid syntax.
+    """
+    return Parser(text).parse_program()
+
+
+# Writing cue.r's records
+
+def records(text, srcref=False):
+    """
+    Yield (level, type, recs) for each node cue.r would write for `text`,
+    in the same order. recs are (name, value) pairs, with the values as in
+    cue.r's framed format.
+    """
+    exprs = parse(text)
+    yield 0, 'expression', []
+
+    for expr, ref in exprs:
+        stack = [(expr, 1, ref if srcref else None)]
+        while stack:
+            obj, level, ref = stack.pop()
+            type_ = typeof(obj)
+
+            if type_ == 'language':
+                recs = []
+                stack.extend((item, level + 1, None)
+                             for item in reversed(obj.items))
+            elif type_ == 'pairlist':
+                recs = []
+                for name, default in obj.args:
+                    recs += [('argname', name),
+                             ('argvalue', as_character(default)),
+                             ('argtype', typeof(default))]
+                # Then each default as a child, as cue.r writes them
+                stack.extend((default, level + 1, None)
+                             for name, default in reversed(obj.args))
+            elif type_ == 'symbol':
+                recs = [('content', obj.name)]
+            else:
+                recs = [('content', obj.value or '')]
+
+            if ref is not None:
+                recs.append(('srcref', '{} {} {} {}'.format(*ref)))
+
+            yield level, type_, recs
+
+
+def _text_line(name, value):
+    line = u' '.join([name] + ([value.decode('utf-8')] if value is not None
+                               else []))
+    line = encode_string(line)
+    if len(line) > 80:
+        line = line[:77] + u'...'
+    return line.encode('utf-8')
+
+
+def format_text(nodes):
+    """Write nodes from records() in cue.r's text format, a line at a time."""
+    for level, type_, recs in nodes:
+        yield '.level {}\n'.format(level)
+        yield '.type {}\n'.format(type_)
+
+        for name, value in recs:
+            yield _text_line('.' + name, value) + '\n'
+        yield '\n'
+
+
+def format_framed(nodes):
+    """Write nodes from records() in cue.r's framed format, a record at a time."""
+    for level, type_, recs in nodes:
+        for name, value in [('level', str(level)), ('type', type_)] + recs:
+            yield '{} {}\n{}\n'.format(name, len(value), value)
+
+
+_formats = {
+    'text': format_text,
+    'framed': format_framed,
+}
+
+
+def build_tree(text, Node, srcref=False):
+    """
+    Parse `text` straight into a tree of `Node`s, without writing records:
+    the same tree the reader builds from cue.r's framed output.
+    """
+    stack = []
+    root = None
+
+    for level, type_, recs in records(text, srcref):
+        node = Node(level, type_, [Rec(name, value or None)
+                                   for name, value in recs])
+        while stack and stack[-1].level >= level:
+            stack.pop()
+        if stack:
+            stack[-1].children.append(node)
+        else:
+            root = node
+        stack.append(node)
+
+    return root
+
+
+_source_hash = None
+
+def source_hash():
+    """A hash of this module's source, looked up once."""
+    global _source_hash
+
+    if _source_hash is None:
+        path = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+        with open(path, 'rb') as fh:
+            _source_hash = hashlib.sha1(fh.read()).hexdigest()
+
+    return _source_hash
+
+
+class ParserWorker(object):
+
+    """
+    A drop-in replacement for translate.CueWorker that parses in process.
+
+    Syntax errors are raised as RSyntaxError, a CueError. The options
+    name rparse and the hash of its source, so a CueCache keeps its
+    entries apart from cue.r's, and editing this module invalidates them.
+    """
+
+    def __init__(self, format='framed', srcref=False):
+        self.format = format
+        self.srcref = srcref
+        self.options = ['rparse=' + source_hash()[:16], '--format=' + format]
+        if srcref:
+            self.options.append('--srcref')
+
+    alive = True
+
+    def start(self):
+        pass
+
+    def close(self):
+        pass
+
+    def stream(self, text):
+        # Parse everything first, so that a syntax error is raised here
+        # rather than part way through the output
+        nodes = list(records(text, self.srcref))
+        return _formats[self.format](nodes)
+
+    def run(self, text):
+        return ''.join(self.stream(text))
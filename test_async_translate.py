@@ -0,0 +1,65 @@
+from nose.plugins.skip import SkipTest
+from nose.tools import assert_raises, eq_
+
+try:
+    import trollius as asyncio
+    from trollius import From
+except ImportError:
+    raise SkipTest('trollius is not installed')
+
+from async_translate import AsyncCuePool, AsyncCueWorker, translate_async
+from translate import CueError, CueTimeout, translate
+
+
+def run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+def test_translate_async():
+    pool = AsyncCuePool(2)
+
+    @asyncio.coroutine
+    def main():
+        sources = ['n <- 1', '1 + 2'] * 5
+        tasks = [translate_async(raw, pool) for raw in sources]
+        results = yield From(asyncio.gather(*tasks))
+        eq_(results, [translate(raw) for raw in sources])
+
+        with assert_raises(CueError):
+            yield From(translate_async('1 +', pool))
+
+        yield From(pool.close())
+
+    run(main())
+
+
+def test_timeout():
+    worker = AsyncCueWorker()
+
+    @asyncio.coroutine
+    def main():
+        with assert_raises(CueTimeout):
+            yield From(translate_async('n <- 1', worker, timeout=1e-6))
+        assert not worker.alive
+
+        # The next request starts a fresh R process
+        eq_((yield From(translate_async('n <- 1', worker))), '\nn = 1')
+        yield From(worker.close())
+
+    run(main())
+
+
+def test_cancel():
+    worker = AsyncCueWorker()
+
+    @asyncio.coroutine
+    def main():
+        task = asyncio.async(translate_async('1 + 2', worker))
+        yield From(asyncio.sleep(0))
+        task.cancel()
+
+        eq_((yield From(translate_async('n <- 1', worker))), '\nn = 1')
+        assert task.cancelled()
+        yield From(worker.close())
+
+    run(main())
@@ -0,0 +1,82 @@
+from nose.tools import eq_
+
+from incremental import IncrementalTranslator
+from translate import CueWorker, translate
+
+
+class RecordingWorker(CueWorker):
+
+    def __init__(self):
+        CueWorker.__init__(self, srcref=True)
+        self.texts = []
+
+    def run(self, text):
+        self.texts.append(text)
+        return CueWorker.run(self, text)
+
+
+source = '''# setup
+x <- 1
+y <- x + 2; z <- 3
+
+foo <- function(a) {
+  return(a + 1)
+}
+
+w <- foo(y)
+'''
+
+
+def test_incremental():
+    worker = RecordingWorker()
+    translator = IncrementalTranslator(worker)
+
+    try:
+        eq_(translator.translate(source), translate(source))
+        eq_(worker.texts, [source])
+
+        edited = source.replace('return(a + 1)', 'return(a + 2)')
+        eq_(translator.translate(edited), translate(edited))
+        eq_(worker.texts[-1], '\nfoo <- function(a) {\n  return(a + 2)\n}\n')
+
+        # Unchanged source doesn't need R at all
+        eq_(translator.translate(edited), translate(edited))
+        eq_(len(worker.texts), 2)
+    finally:
+        worker.close()
+
+
+def test_incremental_reparse():
+    worker = RecordingWorker()
+    translator = IncrementalTranslator(worker)
+
+    try:
+        translator.translate(source)
+
+        # `bar <- function()` doesn't parse on its own: the unchanged
+        # definition of foo after it becomes bar's body
+        edited = source.replace('y <- x + 2; z <- 3', 'bar <- function()')
+        eq_(translator.translate(edited), translate(edited))
+        eq_(worker.texts[-2:], ['bar <- function()\n', edited])
+    finally:
+        worker.close()
+
+
+def test_incremental_imports():
+    worker = RecordingWorker()
+    translator = IncrementalTranslator(worker)
+    lazy = 'f <- function(a, b = a) b\ng <- function(c, d = c) d\n'
+    promise = 'from promise import MISSING, Promise, force\n'
+
+    try:
+        python = translator.translate(lazy)
+        eq_(python, translate(lazy))
+        eq_(python.count(promise), 1)
+
+        # The import stays when the function first needing it is edited
+        edited = lazy.replace('b = a', 'b = 2')
+        python = translator.translate(edited)
+        eq_(python, translate(edited))
+        eq_(python.count(promise), 1)
+    finally:
+        worker.close()
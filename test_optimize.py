@@ -0,0 +1,81 @@
+import ast
+
+from nose.tools import eq_
+
+from optimize import Optimizer
+from rparse import ParserWorker
+from translate import NumpyTransformer, translate
+
+
+worker = ParserWorker()
+
+
+optimizations = (
+    ('x <- 60 * 60 * 24', 'x = 86400'),
+    ('x <- 1 + 2 + y', 'x = (3 + y)'),
+    ('x <- y + 1 + 2', 'x = ((y + 1) + 2)'),
+    ('x <- -3', 'x = (-3)'),
+    ('x <- 1 / 0', 'x = (1 / 0)'),
+    ('x <- 2 ^ 1000', 'x = (2 ** 1000)'),
+    ('x <- "a" == "b"', 'x = False'),
+    ('x <- toupper("abc")', "x = 'ABC'"),
+    ('x <- !TRUE', 'x = False'),
+    ('x <- TRUE && y', 'x = y'),
+    ('x <- FALSE && y', 'x = False'),
+    ('x <- FALSE || y', 'x = y'),
+
+    ('if (FALSE) print(1)', ''),
+    ('if (TRUE) { a <- 1; b <- 2 }', 'a = 1\nb = 2'),
+    ('if (0) a <- 1 else b <- 2', 'b = 2'),
+    ('if (x) print(1) else if (FALSE) print(2) else print(3)',
+     'if x:\n    print(1)\nelse:\n    print(3)'),
+    ('if (x) { if (FALSE) print(1) }', 'if x:\n    pass'),
+
+    ('1 + 2', ''),
+    ('f <- function(x) { "doc"; 1; x }', 'def f(x):\n    x'),
+    # R's function value
+    ('f <- function() 1 + 2', 'def f():\n    3'),
+    ('f <- function() if (TRUE) 1 else 2', 'def f():\n    1'),
+)
+
+def check_optimization(raw, expected):
+    eq_(translate(raw, worker, optimize=True).lstrip('\n'), expected)
+
+def test_optimizations():
+    for raw, expected in optimizations:
+        yield check_optimization, raw, expected
+
+
+def test_off_by_default():
+    eq_(translate('x <- 1 + 2', worker), '\nx = (1 + 2)')
+
+
+numpy_optimizations = (
+    ('c(1, 2) * (2 + 3)', 'np.multiply(np.array([1, 2]), 5)'),
+    ('2 ^ 10 > 1000', 'True'),
+    ('1 / 2', '0.5'),
+    # NumPy's int64 arithmetic wraps around
+    ('1152921504606846976 * 1024', 'np.multiply(1152921504606846976, 1024)'),
+    ('2 ^ -1', '0.5'),
+    ('2 ^ 70', '1.1805916207174113e+21'),
+)
+
+def check_numpy_optimization(raw, expected):
+    eq_(translate('x <- ' + raw, worker, transformer=NumpyTransformer,
+                  optimize=True),
+        '\nimport numpy as np\nx = ' + expected)
+
+def test_numpy():
+    for raw, expected in numpy_optimizations:
+        yield check_numpy_optimization, raw, expected
+
+
+def test_deep_chain():
+    # 1 + 2 + ... + n, nested too deep to optimize recursively
+    n = 100000
+    tree = ast.Num(1)
+    for i in range(2, n + 1):
+        tree = ast.BinOp(tree, ast.Add(), ast.Num(i))
+    tree = ast.Assign([ast.Name('x', ast.Store())], tree)
+
+    eq_(Optimizer().optimize(tree).value.n, n * (n + 1) // 2)
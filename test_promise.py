@@ -0,0 +1,43 @@
+from nose.tools import assert_raises, eq_
+
+from promise import MISSING, Promise, force
+
+
+def test_force():
+    calls = []
+    def thunk():
+        calls.append(1)
+        return 42
+
+    promise = Promise(thunk)
+    assert not promise.forced
+    eq_(calls, [])
+
+    eq_(force(promise), 42)
+    eq_(force(promise), 42)
+    assert promise.forced
+    eq_(calls, [1])
+
+    eq_(force(3), 3)
+    eq_(force(MISSING), MISSING)
+
+
+def test_recursive():
+    promise = Promise(lambda: force(promise) + 1)
+    with assert_raises(RuntimeError):
+        promise.force()
+
+
+def test_retry_after_error():
+    values = iter([ZeroDivisionError, 5])
+    def thunk():
+        value = next(values)
+        if value is ZeroDivisionError:
+            raise value()
+        return value
+
+    promise = Promise(thunk)
+    with assert_raises(ZeroDivisionError):
+        promise.force()
+    assert not promise.forced
+    eq_(promise.force(), 5)
@@ -1,6 +1,10 @@
-from nose.tools import eq_
+import os
+import tempfile
 
-from reader import reader, Rec
+from nose.tools import assert_raises, eq_
+
+from reader import (map_file, ParseError, reader, read_subtrees, read_tree,
+                    Rec)
 
 
 def test_reader():
@@ -70,6 +74,102 @@ def test_reader():
     eq_(children, expected)
 
 
+def test_read_subtrees():
+    subtrees = list(read_subtrees(dummy_lines))
+
+    eq_([(node.level, node.type) for node in subtrees],
+        [(1, 'language'), (1, 'language')])
+    eq_([len(node.children) for node in subtrees], [3, 2])
+    eq_(subtrees[0].children[2].children[2].recs, [Rec('content', '1')])
+
+
+def test_deep_nesting():
+    depth = 10000
+    lines = []
+    for level in range(depth):
+        lines += ['.level {}'.format(level), '.type language', '']
+
+    node = read_tree(lines)
+    for level in range(depth - 1):
+        eq_(len(node.children), 1)
+        node = node.children[0]
+    eq_(node.level, depth - 1)
+
+
+def test_text_buffer():
+    # The whole output as one string reads the same as a list of lines
+    nodes = list(reader('\n'.join(dummy_lines)))
+
+    eq_([(n.level, n.type, n.recs) for n in nodes],
+        [(n.level, n.type, n.recs) for n in reader(dummy_lines)])
+
+    with assert_raises(ParseError):
+        list(reader('.level 0\n.\n'))
+
+
+def test_streamed_lines():
+    # Lines with their newlines, as a worker streams them, over several
+    # scanned batches
+    buf = '\n'.join(dummy_lines * 100)
+    expected = [(n.level, n.type, n.recs) for n in reader(buf)]
+
+    lines = iter(buf.splitlines(True))
+    eq_([(n.level, n.type, n.recs) for n in reader(lines)], expected)
+    eq_(len(expected), 1200)
+
+    with assert_raises(ParseError):
+        list(reader(iter(['.level 0\n', '.\n'])))
+
+
+def test_map_file():
+    fd, path = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, 'w') as fh:
+            fh.write('\n'.join(dummy_lines))
+
+        with map_file(path) as buf:
+            nodes = list(reader(buf))
+            subtrees = list(read_subtrees(buf))
+
+        eq_([(n.level, n.type, n.recs) for n in nodes],
+            [(n.level, n.type, n.recs) for n in reader(dummy_lines)])
+        eq_(len(subtrees), 2)
+    finally:
+        os.remove(path)
+
+
+def framed(lines):
+    out = []
+    for line in lines:
+        if line:
+            name, _, value = line[1:].partition(' ')
+            out.append('{} {}\n{}\n'.format(name, len(value), value))
+    return ''.join(out)
+
+
+def test_framed_reader():
+    text_nodes = list(reader(dummy_lines))
+    framed_nodes = list(reader(framed(dummy_lines), format='framed'))
+
+    eq_([(n.level, n.type, n.recs) for n in framed_nodes],
+        [(n.level, n.type, n.recs) for n in text_nodes])
+    eq_([len(n.children) for n in framed_nodes],
+        [len(n.children) for n in text_nodes])
+
+
+def test_framed_values():
+    # Values are raw bytes: no escaping, no truncation
+    value = 'a\nb ' + 'x' * 100
+    buf = 'level 1\n0\ntype 9\ncharacter\ncontent {}\n{}\n'.format(
+        len(value), value)
+
+    root = read_tree(buf, format='framed')
+    eq_(root.content, value)
+
+    with assert_raises(ParseError):
+        read_tree(buf[:-2], format='framed')
+
+
 dummy_lines = '''
 .level 0
 .type expression
@@ -0,0 +1,105 @@
+import shutil
+import tempfile
+
+from nose.tools import assert_raises, eq_
+
+from reader import reader
+from rparse import (Call, Const, ParserWorker, RSyntaxError, Sym,
+                    build_tree, format_double, format_framed, format_text,
+                    parse, records)
+from translate import CueCache, CueError, translate, translate_cue_code
+import test_reader
+from test_translate import errors, translations
+
+
+worker = ParserWorker()
+
+
+def check_translation(raw, expected):
+    eq_(translate(raw, worker).lstrip('\n'), expected)
+
+def test_translations():
+    for raw, expected in translations:
+        yield check_translation, raw, expected
+
+
+def expect_syntax_error(raw):
+    with assert_raises(CueError):
+        translate(raw, worker)
+
+def test_errors():
+    for raw in errors + ('1 +', 'f(', '"abc', 'x <- )'):
+        yield expect_syntax_error, raw
+
+
+def test_text_format():
+    raw = 'foo <- function() 1\nfunction(x, bar=foo, gz=2) NULL'
+
+    text = [(n.level, n.type, n.recs)
+            for n in reader(''.join(format_text(records(raw))))]
+    framed = [(n.level, n.type, n.recs)
+              for n in reader(''.join(format_framed(records(raw))),
+                              format='framed')]
+
+    # dummy_lines stops short of the second function's body
+    eq_(text[:12], [(n.level, n.type, n.recs)
+                    for n in reader(test_reader.dummy_lines)])
+    eq_(framed, text)
+
+
+def test_parse():
+    eq_(parse('1 + 2 * 3'), [
+        (Call([Sym('+'), Const('double', '1'),
+               Call([Sym('*'), Const('double', '2'), Const('double', '3')])]),
+         (1, 1, 1, 9)),
+    ])
+
+    # ^ binds tighter than unary minus, and -> is stored as <-
+    eq_([expr for expr, ref in parse('-2^2\nx -> y')], [
+        Call([Sym('-'),
+              Call([Sym('^'), Const('double', '2'), Const('double', '2')])]),
+        Call([Sym('<-'), Sym('y'), Sym('x')]),
+    ])
+
+    with assert_raises(RSyntaxError):
+        parse('1 < 2 < 4')
+
+
+def test_format_double():
+    for x, expected in [(1.0, '1'), (0.1 + 0.2, '0.3'), (100000.0, '1e+05'),
+                        (123456.0, '123456'), (1e-20, '1e-20')]:
+        eq_(format_double(x), expected)
+
+
+def test_build_tree():
+    from reader import Node
+
+    raw = 'f(x, y = 2)[[1]]'
+    tree = build_tree(raw, Node)
+    nodes = list(reader(worker.run(raw), format='framed'))
+
+    def flatten(node):
+        yield node.level, node.type, node.recs
+        for child in node.children:
+            for item in flatten(child):
+                yield item
+
+    eq_(list(flatten(tree)), [(n.level, n.type, n.recs) for n in nodes])
+    eq_(translate_cue_code(worker.run(raw), 'framed').lstrip('\n'),
+        translate(raw, worker).lstrip('\n'))
+
+
+def test_cache_key():
+    # Editing rparse.py invalidates the records cached from it
+    import rparse
+
+    path = tempfile.mkdtemp()
+    saved = rparse.source_hash()
+    try:
+        cache = CueCache(path, version='test')
+        key = cache.key('x', ParserWorker().options)
+        rparse._source_hash = '0' * 40
+        assert cache.key('x', ParserWorker().options) != key
+    finally:
+        rparse._source_hash = saved
+        shutil.rmtree(path)
@@ -1,15 +1,25 @@
-import hashlib
 import os
+import shutil
+from StringIO import StringIO
+import tempfile
+import threading
+import time
 
 from nose.tools import assert_raises, eq_
 
-from translate import translate, translate_cue_code, CueError, run_cue
+from rparse import ParserWorker
+from translate import (translate, translate_cue_code, translate_cue_file,
+                       translate_many, translate_tree, translate_with_stats,
+                       CueCache, CuePool, NumpyTransformer,
+                       CueError, CueLimitError, CueTimeout, CueWorker,
+                       UnknownError, run_cue)
 
 
-CACHE_DIR = '.cue_output_test_cache'
+# Cache the cue output because it's fairly slow to run R for every test
+cache = CueCache('.cue_output_test_cache')
 
-if not os.path.exists(CACHE_DIR):
-    os.mkdir(CACHE_DIR)
+# For the tests that don't depend on R's parser
+worker = ParserWorker()
 
 
 # TODO consider comparing to ast.dump() so that you know tree is exact
@@ -87,28 +97,30 @@ translations = (
 
     ('foo(1)(bar())', 'foo(1)(bar())'),
 
-    ('foo[[1]]', 'foo[1]'),
+    # R counts from 1
+    ('foo[[1]]', 'foo[0]'),
+    ('x[i]', 'x[(i - 1)]'),
+    ('x[i + 1]', 'x[i]'),
+    ('x[2:n]', 'x[1:n]'),
+    ('x[x > 0]', 'x[(x > 0)]'),
+    ('m[i, j]', 'm[(i - 1), (j - 1)]'),
+    ('df[, 1]', 'df[:, 0]'),
+    ('m[i, j] <- v', 'm[(i - 1), (j - 1)] = v'),
+    ('x[+2]', 'x[1]'),
+    ('x[["a"]]', "x['a']"),
+    ('df[, "col"]', "df[:, 'col']"),
+
+    ('f(1)\ng(2)', 'f(1)\ng(2)'),
+
+    # Python needs a body
+    ('for (i in c(1, 2, 3)) {}', 'for i in c(1, 2, 3):\n    pass'),
+    ('f <- function() {}', 'def f():\n    pass'),
+    ('if (x) {}', 'if x:\n    pass'),
 )
 
 
 def check_translation(raw, expected):
-    # Cache the cue output because it's fairly slow to start a cue process
-    # for every test
-    #
-    # TODO include some kind of cue version in this hash, so that the cache
-    #      is invalidated by updates to cue.r and/or the cue runner
-    m = hashlib.md5()
-    m.update(raw)
-    hashcode = m.hexdigest()
-    cache_path = os.path.join(CACHE_DIR, hashcode)
-
-    if os.path.exists(cache_path):
-        cue_code = open(cache_path).read()
-    else:
-        cue_code = run_cue(raw)
-        with open(cache_path, 'w') as fh:
-            fh.write(cue_code)
-
+    cue_code = run_cue(raw, cache=cache)
     eq_(translate_cue_code(cue_code).lstrip('\n'), expected)
 
 def test_translations():
@@ -134,3 +146,364 @@ def expect_cue_error(raw):
 def test_errors():
     for raw in errors:
         yield expect_cue_error, raw
+
+
+def test_negative_index():
+    # R drops the first element, where Python would pick another
+    with assert_raises(UnknownError):
+        translate('x[-1]', worker)
+    with assert_raises(UnknownError):
+        translate('x[-1]', worker, transformer=NumpyTransformer)
+
+
+def test_worker_reuse():
+    worker = CueWorker()
+    try:
+        first = worker.run('n <- 1')
+        pid = worker.proc.pid
+
+        # A parse error is reported without killing the worker
+        with assert_raises(CueError):
+            worker.run('1, 2')
+
+        eq_(worker.run('n <- 1'), first)
+        eq_(worker.proc.pid, pid)
+    finally:
+        worker.close()
+
+
+def test_worker_limits():
+    worker = CueWorker(timeout=0.001)
+    try:
+        # R can't even start up in a millisecond
+        with assert_raises(CueTimeout):
+            worker.run('n <- 1')
+        assert not worker.alive
+
+        worker.timeout = None
+        expected = worker.run('n <- 1')
+        eq_(''.join(worker.stream('n <- 1')), expected)
+
+        worker.max_output = len(expected) - 1
+        with assert_raises(CueLimitError):
+            worker.run('n <- 1')
+        assert not worker.alive
+    finally:
+        worker.close()
+
+
+def test_worker_timeout_excludes_consumer():
+    worker = CueWorker()
+    try:
+        expected = worker.run('n <- 1')
+
+        # Only R's time counts, not the time spent with each chunk
+        worker.timeout = 0.5
+        chunks = []
+        for chunk in worker.stream('n <- 1'):
+            time.sleep(0.1)
+            chunks.append(chunk)
+        assert len(chunks) * 0.1 > worker.timeout
+        eq_(''.join(chunks), expected)
+        assert worker.alive
+    finally:
+        worker.close()
+
+
+def test_default_worker_threads():
+    # Threads share the default worker, and must take turns at it
+    raws = [raw for raw, expected in translations[:8]]
+    expected = [translate(raw) for raw in raws]
+    results = {}
+
+    def work(i):
+        results[i] = [translate(raw) for raw in raws]
+
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    eq_(results, dict((i, expected) for i in range(4)))
+
+
+def test_translate_with_stats():
+    code, stats = translate_with_stats('n <- 1')
+    eq_(code, translate('n <- 1'))
+
+    # expression, language, and the symbols <- and n and the double 1
+    eq_(stats.nodes, 5)
+    eq_(stats.records, 5 * 2 + 3)
+    eq_(stats.expressions, 1)
+    eq_(stats.source_bytes, len('n <- 1'))
+    eq_(stats.output_bytes, len(code))
+    assert stats.cue_bytes > 0
+    assert not stats.cached
+    assert stats.total >= stats.times['transform']
+
+    path = tempfile.mkdtemp()
+    try:
+        cache = CueCache(path, version='test')
+        translate_with_stats('n <- 1', cache=cache)
+        code, stats = translate_with_stats('n <- 1', cache=cache)
+        assert stats.cached
+        eq_(stats.times['r'], 0)
+    finally:
+        shutil.rmtree(path)
+
+
+def test_translate_many():
+    raws = [raw for raw, expected in translations]
+    expected = [expected for raw, expected in translations]
+
+    results = translate_many(raws, workers=2)
+    eq_([code.lstrip('\n') for code in results], expected)
+
+
+def test_translate_many_sources_error():
+    def sources():
+        yield 'n <- 1'
+        yield 'x'
+        raise ValueError('no more sources')
+
+    results = translate_many(sources(), workers=2)
+    eq_(next(results), '\nn = 1')
+    eq_(next(results), '\nx')
+    with assert_raises(ValueError):
+        next(results)
+
+
+def test_failed_translation_releases_worker():
+    # Fails part way through the records, with most of R's reply unread
+    bad = 'x <- 1.5\n' + 'y <- 2\n' * 500
+    pool = CuePool(1)
+    try:
+        with assert_raises(ValueError):
+            translate(bad, pool)
+        with assert_raises(ValueError):
+            translate_with_stats(bad, pool)
+        eq_(translate('n <- 1', pool), '\nn = 1')
+
+        results = translate_many([bad, 'n <- 1'], pool=pool,
+                                 raise_errors=False)
+        assert isinstance(next(results), ValueError)
+        eq_(next(results), '\nn = 1')
+    finally:
+        pool.close()
+
+
+def test_translate_tree():
+    src = tempfile.mkdtemp()
+    dest = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(src, 'sub'))
+        for name, raw in [('a.r', 'n <- 1'), ('sub/b.R', 'x'), ('c.r', '1 +'),
+                          ('d.r', 'return(1)'), ('notes.txt', '')]:
+            with open(os.path.join(src, name), 'w') as fh:
+                fh.write(raw)
+
+        results = translate_tree(src, dest, processes=2, backend='python')
+        failed = [path for path, size, elapsed, error in results if error]
+        # c.r doesn't parse, and d.r's translation doesn't compile
+        eq_(sorted(failed),
+            [os.path.join(src, 'c.r'), os.path.join(src, 'd.r')])
+
+        with open(os.path.join(dest, 'a.py')) as fh:
+            eq_(fh.read(), '\nn = 1')
+        with open(os.path.join(dest, 'sub', 'b.py')) as fh:
+            eq_(fh.read(), '\nx')
+        assert not os.path.exists(os.path.join(dest, 'c.py'))
+        assert not os.path.exists(os.path.join(dest, 'd.py'))
+
+        # Up to date outputs are skipped
+        eq_(sorted(path for path, size, elapsed, error
+                   in translate_tree(src, dest, backend='python')),
+            [os.path.join(src, 'c.r'), os.path.join(src, 'd.r')])
+    finally:
+        shutil.rmtree(src)
+        shutil.rmtree(dest)
+
+
+apply_translations = (
+    ('lapply(xs, function(x) x + 1)', '[(x + 1) for x in xs]'),
+    ('sapply(xs, f)', 'map(f, xs)'),
+    ('lapply(xs, f, 2)', '[f(_x0, 2) for _x0 in xs]'),
+    ('vapply(xs, function(x) return(x * 2), numeric(1))',
+     '[(x * 2) for x in xs]'),
+    ('mapply(function(a, b) a + b, xs, ys)',
+     '[(a + b) for (a, b) in zip(xs, ys)]'),
+    ('seq_along(x)', 'range(1, (len(x) + 1))'),
+)
+
+def check_apply_translation(raw, expected):
+    eq_(translate('y <- ' + raw, worker), '\ny = ' + expected)
+
+def test_apply_translations():
+    for raw, expected in apply_translations:
+        yield check_apply_translation, raw, expected
+
+
+def test_for():
+    eq_(translate('for (i in 1:n) {\n  y[i] <- x[i]\n  print(i)\n}', worker),
+        '\nfor i in range(1, (n + 1)):\n    y[(i - 1)] = x[(i - 1)]'
+        '\n    print(i)')
+
+    namespace = {'x': [1, 2, 3], 'y': [0, 0, 0]}
+    exec translate('for (i in seq_along(x)) y[i] <- x[i] * 2',
+                   worker) in namespace
+    eq_(namespace['y'], [2, 4, 6])
+
+
+numpy_translations = (
+    ('c(1, 2, 3)', 'np.array([1, 2, 3])'),
+    ('c(x, 4)', 'np.hstack([x, 4])'),
+    ('x * 2 + 1', 'np.add(np.multiply(x, 2), 1)'),
+    ('x / 2', 'np.true_divide(x, 2)'),
+    ('x ^ 2', 'np.float_power(x, 2)'),
+    ('x ^ -1', 'np.float_power(x, np.negative(1))'),
+    ('x > 1 & y | !z',
+     'np.logical_or(np.logical_and(np.greater(x, 1), y), np.logical_not(z))'),
+    ('x && y', '(x and y)'),
+    ('sqrt(sum(x))', 'np.sqrt(np.sum(x))'),
+    ('ceiling(-x)', 'np.ceil(np.negative(x))'),
+    ('foo(x)', 'foo(x)'),
+    ('sapply(xs, f)', 'np.array(map(f, xs))'),
+
+    # NumPy's functions take other arguments than R's
+    ('max(x, 0)', 'max(x, 0)'),
+    ('sum(a, b)', 'sum(a, b)'),
+    ('mean(x, na.rm = TRUE)', 'mean(x, True)'),
+    ('pmax(x, 0)', 'np.maximum(x, 0)'),
+    ('log(x)', 'np.log(x)'),
+    ('log(x, 2)', 'np.true_divide(np.log(x), np.log(2))'),
+)
+
+def check_numpy_translation(raw, expected):
+    code = translate('y <- ' + raw, worker, transformer=NumpyTransformer)
+    eq_(code, '\nimport numpy as np\ny = ' + expected)
+
+def test_numpy_translations():
+    for raw, expected in numpy_translations:
+        yield check_numpy_translation, raw, expected
+
+
+loops = (
+    # Elementwise: one array expression
+    ('for (i in 1:n) y[i] <- sqrt(x[i]) + 1',
+     '\ny[0:n] = np.add(np.sqrt(x[0:n]), 1)'),
+    ('for (i in 1:n) y[i] <- y[i] * 2',
+     '\ny[0:n] = np.multiply(y[0:n], 2)'),
+    ('for (i in 3) y[i] <- x[i]', '\ny[2] = x[2]'),
+
+    # Each iteration depends on the last
+    ('for (i in 2:n) y[i] <- y[i - 1] + x[i]',
+     '\nfor i in np.arange(2, (n + 1)):'
+     '\n    y[(i - 1)] = np.add(y[(i - 2)], x[(i - 1)])'),
+    # idx may repeat an index
+    ('for (i in idx) y[i] <- y[i] + 1',
+     '\nfor i in idx:\n    y[(i - 1)] = np.add(y[(i - 1)], 1)'),
+    # f may not be elementwise
+    ('for (i in 1:n) y[i] <- f(x[i])',
+     '\nfor i in np.arange(1, (n + 1)):\n    y[(i - 1)] = f(x[(i - 1)])'),
+)
+
+def check_numpy_loop(raw, expected):
+    code = translate(raw, worker, transformer=NumpyTransformer)
+    eq_(code, '\nimport numpy as np' + expected)
+
+def test_numpy_loops():
+    for raw, expected in loops:
+        yield check_numpy_loop, raw, expected
+
+
+def test_lazy_defaults():
+    # Constant defaults stay Python defaults
+    eq_(translate('f <- function(x = 1, s = "a", n = NULL) x', worker),
+        "\n\ndef f(x=1, s='a', n=None):\n    x")
+    eq_(translate('f <- function(x = -1, y = +2) x', worker),
+        '\n\ndef f(x=(-1), y=2):\n    x')
+    eq_(translate('f <- function(x = -1) x', worker,
+                  transformer=NumpyTransformer),
+        '\nimport numpy as np\n\ndef f(x=(-1)):\n    x')
+
+    # Others are evaluated when first used, in the function's frame
+    code = translate('f <- function(x, y = z * z, w = stop("unused")) {\n'
+                     '  z <- x + 1\n  return(y + y)\n}', worker)
+    namespace = {}
+    exec code in namespace
+    eq_(namespace['f'](2), 18)
+    eq_(namespace['f'](2, 1), 2)
+
+    code = translate('f <- function(x, n = length(x), m = n + 1) m', worker)
+    assert 'm = Promise((lambda : (force(n) + 1)))' in code
+
+
+def test_cache():
+    path = tempfile.mkdtemp()
+    try:
+        c = CueCache(path, max_bytes=10, version='test')
+
+        eq_(c.get('1'), None)
+        c.put('1', '12345')
+        eq_(c.get('1'), '12345')
+        eq_((c.hits, c.misses), (1, 1))
+
+        # Putting an entry again replaces it
+        c.put('1', '12345')
+        eq_(c._size, 5)
+
+        # A different R version doesn't see the entry
+        eq_(CueCache(path, version='other').get('1'), None)
+
+        # Going over max_bytes evicts the least recently used entry
+        os.utime(os.path.join(path, c.key('1')), (0, 0))
+        c.put('2', '67890')
+        c.put('3', 'abc')
+        eq_(c.get('1'), None)
+        eq_(c.get('2'), '67890')
+    finally:
+        shutil.rmtree(path)
+
+
+def test_translate_cue_file():
+    raw = 'n <- 1\nfoo <- function(x) return(x + 1)\nfoo(n)'
+    cue_code = run_cue(raw, cache=cache)
+
+    fd, path = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(cue_code)
+
+        out = StringIO()
+        translate_cue_file(path, out)
+        eq_(out.getvalue(), translate_cue_code(cue_code))
+    finally:
+        os.remove(path)
+
+
+def chain_cue_code(n):
+    """Cue output for `1 + 2 + ... + n`, a left-nested chain n - 1 deep."""
+    lines = ['.level 0', '.type expression', '']
+    for level in range(1, n):
+        lines += ['.level {}'.format(level), '.type language', '',
+                  '.level {}'.format(level + 1), '.type symbol', '.content +']
+    lines += ['.level {}'.format(n), '.type double', '.content 1']
+    for level in range(n - 1, 0, -1):
+        lines += ['.level {}'.format(level + 1), '.type double',
+                  '.content {}'.format(n - level + 1)]
+    return '\n'.join(lines)
+
+
+def test_deep_chain():
+    eq_(translate_cue_code(chain_cue_code(4)), '\n(((1 + 2) + 3) + 4)')
+
+    code = translate_cue_code(chain_cue_code(100000))
+    eq_(code.count('+'), 99999)
+    assert code.startswith('\n' + '(' * 99999 + '1 + 2)')
+    assert code.endswith('+ 100000)')
+
+    # As nested calls
+    code = translate_cue_code(chain_cue_code(100000),
+                              transformer=NumpyTransformer)
+    eq_(code.count('np.add('), 99999)
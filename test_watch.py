@@ -0,0 +1,90 @@
+import os
+import shutil
+import tempfile
+
+from nose.tools import eq_
+
+from translate import CuePool
+from watch import Daemon, PollingWatcher
+
+
+def write(path, text, mtime=None):
+    with open(path, 'w') as fh:
+        fh.write(text)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+def test_polling_watcher():
+    root = tempfile.mkdtemp()
+    try:
+        a = os.path.join(root, 'a.r')
+        write(a, 'x <- 1', 1000)
+        os.mkdir(os.path.join(root, 'sub'))
+
+        watcher = PollingWatcher(root, interval=0.01)
+        eq_(watcher.poll(0), set())
+
+        b = os.path.join(root, 'sub', 'b.R')
+        write(b, 'y <- 2')
+        write(os.path.join(root, 'notes.txt'), '')
+        eq_(watcher.poll(0), set([b]))
+
+        write(a, 'x <- 2', 2000)
+        eq_(watcher.poll(0), set([a]))
+        eq_(watcher.poll(0), set())
+    finally:
+        shutil.rmtree(root)
+
+
+class ListWatcher(object):
+
+    interval = 0
+
+    def __init__(self):
+        self.changes = []
+
+    def poll(self, timeout=None):
+        return self.changes.pop(0) if self.changes else set()
+
+    def close(self):
+        pass
+
+
+def test_debounce():
+    daemon = Daemon('.', pool=object(), watcher=ListWatcher(), debounce=1)
+
+    daemon.queue(set(['a.r']), now=10)
+    daemon.queue(set(['b.r']), now=10.5)
+    eq_(daemon.ready(now=11), {})
+    eq_(daemon.status()['queued'], 2)
+
+    eq_(daemon.ready(now=11.5), {'a.r': 10, 'b.r': 10.5})
+    eq_(daemon.status()['queued'], 0)
+
+
+def test_daemon():
+    root = tempfile.mkdtemp()
+    pool = CuePool(2)
+    watcher = ListWatcher()
+    daemon = Daemon(root, pool, watcher=watcher, debounce=0)
+
+    try:
+        a = os.path.join(root, 'a.r')
+        b = os.path.join(root, 'b.r')
+        write(a, 'n <- 1')
+        write(b, '1 +')
+
+        watcher.changes.append(set([a, b]))
+        daemon.step()
+
+        with open(os.path.join(root, 'a.py')) as fh:
+            eq_(fh.read(), '\nn = 1')
+        assert not os.path.exists(os.path.join(root, 'b.py'))
+
+        status = daemon.status()
+        eq_(status['translated'], 1)
+        eq_(list(status['failed']), [b])
+    finally:
+        pool.close()
+        shutil.rmtree(root)
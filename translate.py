@@ -1,37 +1,45 @@
 # http://cran.r-project.org/doc/manuals/r-release/R-lang.html
 
+import argparse
 import ast
+import atexit
+import cProfile
+import hashlib
+import logging
+import multiprocessing
+import os
+import Queue
+import resource
+import signal
 from StringIO import StringIO
 import subprocess
+import sys
+import tempfile
+import threading
+import time
 
 from more_itertools import chunked
 
-from reader import reader
+from optimize import is_constant, Optimizer
+from reader import map_file, Node, read_subtrees, read_tree
 from unparse import Unparser
 
 
+log = logging.getLogger('cue.translate')
+
+
 class UnknownError(Exception): pass
 
-class CueGeneric(ast.AST):
+class CueGeneric(Node):
 
     """
-    Represents a node in a tree.
-    
-    A tree node has a single parent, a list of children,
-    and a reference to the data it contains.
-    """
+    A reader node, before the Transformer has looked at its type.
 
-    def __init__(self, level, type_, recs):
-        self.level = level
-        self.type = type_
-        self.recs = recs
-        self.children = []
+    This shares reader.Node's slotted layout, so nodes are built once and
+    handed straight to the Transformer.
+    """
 
-        self.content = None
-        for rec in recs:
-            if rec.name == 'content':
-                self.content = rec.value
-            
+    __slots__ = ()
 
     def __repr__(self):
         return '{}({})'.format(self.__class__.__name__, self.type)
@@ -42,13 +50,10 @@ class CueNull(ast.AST): pass
 class CueBody(ast.AST):
     _fields = ['exprs']
 
-class CueExpression(ast.AST):
-    _fields = ['children']
-
 class CuePairlist(ast.AST):
     _fields = ['argslist']
 
-    def __init__(self, recs):
+    def __init__(self, recs, defaults=None):
         self.argslist = []
 
         # TODO make these separate nodes
@@ -56,12 +61,10 @@ class CuePairlist(ast.AST):
         for name, value, type_ in chunked(rec_values, 3):
             self.argslist.append((name, value, type_))
 
-
-class CueLanguage(ast.AST):
-    _fields = ['children']
-
-class CueSymbol(ast.AST):
-    _fields = ['content']
+        # The translated default of each argument, or None if it has none
+        if defaults is None:
+            defaults = [None] * len(self.argslist)
+        self.defaults = defaults
 
 
 class CueFunction(ast.AST):
@@ -80,16 +83,136 @@ class CueAssignOp(ast.operator): pass
 def add_simple_ops():
     # Simple CueOp nodes
     _g = globals()
-    for name in ['Function', 'If', 'Return', 'Block', 'Paren']:
+    for name in ['Function', 'If', 'For', 'Return', 'Block', 'Paren', 'Index',
+                 'Range']:
         name = 'Cue' + name + 'Op'
         _g[name] = type(name, (ast.AST,), {})
 
 add_simple_ops()
 
+
+# R's operator symbols. Op nodes carry no state, so a single instance of
+# each is shared by every node that uses it.
+symbols = {
+    # Binary
+    '<-': CueAssignOp(),
+    '=': CueAssignOp(),
+    '*': ast.Mult(),
+    # TODO this probably isn't true, unless __future__.division is always
+    #      imported. R also has '%/%' for integer division
+    '/': ast.Div(),
+    '+': ast.Add(),
+    '-': ast.Sub(),
+    '%%': ast.Mod(),
+    '^': ast.Pow(),
+    '**': ast.Pow(),
+
+    # Comparison
+    '<': ast.Lt(),
+    '<=': ast.LtE(),
+    '>': ast.Gt(),
+    '>=': ast.GtE(),
+    '==': ast.Eq(),
+    '!=': ast.NotEq(),
+    '%in%': ast.In(),
+    # R doesn't have a simple equivalent to 'is'
+    # http://stackoverflow.com/questions/10912729/r-object-identity
+
+    # Unary
+    '!': ast.Not(),
+
+    # Boolean
+    # TODO the vectorized ops '&' and '|' are only handled by
+    #      NumpyTransformer
+    '&&': ast.And(),
+    '||': ast.Or(),
+
+    # Indexing
+    '[[': CueIndexOp(),
+    '[': CueIndexOp(),
+    ':': CueRangeOp(),
+
+    # Other
+    'function': CueFunctionOp(),
+    'if': CueIfOp(),
+    'for': CueForOp(),
+    '{': CueBlockOp(),
+    '(': CueParenOp(),
+    'return': CueReturnOp(),
+}
+
+
+def op_handlers(handlers):
+    """
+    Expand a list of (op base class, handler) pairs into a table keyed by
+    the concrete class of each op in `symbols`. The first matching base
+    wins.
+    """
+    table = {}
+    for op in symbols.itervalues():
+        for base, handler in handlers:
+            if isinstance(op, base):
+                table[op.__class__] = handler
+                break
+    return table
+
 class CueError(Exception): pass
 
-def run_cue(text):
-    p = subprocess.Popen(['Rscript', 'cue.r'], stdin=subprocess.PIPE,
+class CueTimeout(CueError): pass
+
+class CueLimitError(CueError): pass
+
+
+CUE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cue.r')
+
+
+def cue_options(format='text', srcref=False):
+    """The cue.r command line options that select its output."""
+    options = []
+    if format != 'text':
+        options.append('--format=' + format)
+    if srcref:
+        options.append('--srcref')
+    return options
+
+
+def limit_resources(memory=None, cpu=None):
+    """
+    A preexec_fn for subprocess.Popen that caps the child's address space
+    at `memory` bytes and its CPU time at `cpu` seconds, or None if there
+    are no limits.
+    """
+    if memory is None and cpu is None:
+        return None
+
+    def preexec():
+        if memory is not None:
+            resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+        if cpu is not None:
+            # SIGXCPU at the soft limit, SIGKILL a second later
+            resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu + 1))
+
+    return preexec
+
+
+# R's messages when an allocation fails, as it does under a memory limit
+_memory_errors = ('cannot allocate', 'vector memory exhausted')
+
+def cue_error(message):
+    """The exception for an .error record from cue.r."""
+    if message.startswith(_memory_errors):
+        return CueLimitError(message)
+    return CueError(message)
+
+
+def run_cue_once(text, script=CUE_SCRIPT, format='text', srcref=False):
+    """
+    Run a fresh `Rscript cue.r` process over `text`.
+
+    This pays R's startup cost on every call; run_cue() reuses a worker.
+    """
+    command = ['Rscript', script] + cue_options(format, srcref)
+    p = subprocess.Popen(command, stdin=subprocess.PIPE,
                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
     out, err = p.communicate(text)
@@ -99,181 +222,914 @@ def run_cue(text):
     return out
 
 
+class _Watchdog(object):
+
+    """
+    Call `expire` once `timeout` seconds have passed outside of pauses.
+
+    CueWorker.stream() pauses it while a chunk is with its consumer, so
+    only the time spent waiting for R counts.
+    """
+
+    def __init__(self, timeout, expire):
+        self.deadline = time.time() + timeout
+        self.expire = expire
+        self._paused_at = None
+        self._done = False
+        self._cond = threading.Condition()
+
+        thread = threading.Thread(target=self._watch)
+        thread.daemon = True
+        thread.start()
+
+    def _watch(self):
+        with self._cond:
+            while not self._done:
+                if self._paused_at is not None:
+                    self._cond.wait()
+                    continue
+
+                remaining = self.deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            else:
+                return
+
+        self.expire()
+
+    def pause(self):
+        with self._cond:
+            self._paused_at = time.time()
+
+    def resume(self):
+        with self._cond:
+            self.deadline += time.time() - self._paused_at
+            self._paused_at = None
+            self._cond.notify()
+
+    def cancel(self):
+        with self._cond:
+            self._done = True
+            self._cond.notify()
+
+
+class CueWorker(object):
+
+    """
+    A long-lived `Rscript cue.r --server` process.
+
+    Each source is written to the worker as a length-prefixed block and
+    the record stream is read back up to the ".end" marker, so R's startup
+    cost is paid once per worker instead of once per translation.
+
+    `format` selects cue.r's record format: 'text', or the length-prefixed
+    'framed' format, which is cheaper to write and parse and is not
+    truncated. With `srcref`, each top-level expression carries a .srcref
+    record giving its position in the source.
+
+    A request taking longer than `timeout` seconds, or producing more
+    than `max_output` bytes of records, kills the R process and raises
+    CueTimeout or CueLimitError. The time a stream() consumer spends with
+    each chunk doesn't count against the timeout. `memory` and `cpu` set
+    RLIMIT_AS (bytes) and RLIMIT_CPU (seconds) on the process. The CPU
+    limit covers the process's whole life, not one request. Whatever the
+    limit, the next request starts a fresh process.
+    """
+
+    def __init__(self, script=CUE_SCRIPT, format='text', srcref=False,
+                 timeout=None, max_output=None, memory=None, cpu=None):
+        self.script = script
+        self.format = format
+        self.options = cue_options(format, srcref)
+        self.timeout = timeout
+        self.max_output = max_output
+        self.memory = memory
+        self.cpu = cpu
+        self.proc = None
+
+        # Set while a request's reply hasn't been read up to its end
+        self._busy = False
+        self._timed_out = False
+
+    def start(self):
+        command = ['Rscript', self.script, '--server'] + self.options
+        # Without close_fds, a worker inherits the pipes of every other
+        # live worker, and they don't see end of file when closed. Popen's
+        # default of unbuffered pipes would make each readline() read a
+        # byte at a time.
+        self.proc = subprocess.Popen(command,
+                                     bufsize=-1,
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE,
+                                     close_fds=True,
+                                     preexec_fn=limit_resources(self.memory,
+                                                                self.cpu))
+
+    def close(self):
+        if self.proc is None:
+            return
+
+        proc, self.proc = self.proc, None
+        try:
+            proc.stdin.close()
+        except IOError:
+            pass
+        proc.wait()
+
+    def kill(self):
+        """Stop the R process without waiting for its current request."""
+        proc, self.proc = self.proc, None
+        self._busy = False
+        if proc is None:
+            return
+
+        try:
+            proc.kill()
+        except OSError:
+            pass
+        proc.wait()
+
+    @property
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def _expire(self, proc):
+        # Runs on the timer thread. Killing the process ends the read
+        # in progress, which then reports the timeout.
+        self._timed_out = True
+        try:
+            proc.kill()
+        except OSError:
+            pass
+
+    def _died(self):
+        # The worker exited mid-request. Collect whatever it said on stderr
+        # and drop the process so the next request starts a fresh one.
+        proc, self.proc = self.proc, None
+        self._busy = False
+        err = proc.stderr.read()
+        proc.wait()
+
+        if self._timed_out:
+            return CueTimeout('cue.r took longer than {}s'.format(self.timeout))
+        if self.cpu is not None and proc.returncode in (-signal.SIGXCPU,
+                                                        -signal.SIGKILL):
+            return CueLimitError('cue.r used more than {}s of CPU'.format(self.cpu))
+        return CueError(err or 'cue worker exited with {}'.format(proc.returncode))
+
+    def _too_much_output(self):
+        self.kill()
+        return CueLimitError(
+            'cue.r wrote more than {} bytes'.format(self.max_output))
+
+    def run(self, text):
+        return ''.join(self.stream(text))
+
+    def stream(self, text):
+        """
+        Parse `text`, yielding cue.r's output as it arrives: a line at a
+        time in the text format, a record at a time in the framed format.
+
+        Either way the output can be handed straight to the reader, so it
+        never has to be held in one string. If the generator is abandoned
+        before the end of the reply, the R process is killed.
+        """
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+
+        if not self.alive:
+            self.start()
+
+        proc = self.proc
+        self._timed_out = False
+        watchdog = None
+        if self.timeout is not None:
+            watchdog = _Watchdog(self.timeout, lambda: self._expire(proc))
+
+        try:
+            self._busy = True
+            try:
+                proc.stdin.write('{}\n'.format(len(text)))
+                proc.stdin.write(text)
+                proc.stdin.flush()
+            except IOError:
+                raise self._died()
+
+            if self.format == 'framed':
+                read = self._read_framed
+            else:
+                read = self._read_text
+
+            if watchdog is None:
+                for chunk in read():
+                    yield chunk
+            else:
+                for chunk in read():
+                    watchdog.pause()
+                    yield chunk
+                    watchdog.resume()
+
+        finally:
+            if watchdog is not None:
+                watchdog.cancel()
+            if self._busy and self.proc is proc:
+                self.kill()
+
+    def _read_text(self):
+        limit = self.max_output
+        size = 0
+        error = None
+
+        for line in iter(self.proc.stdout.readline, ''):
+            if line.rstrip('\n') == '.end':
+                break
+
+            size += len(line)
+            if limit is not None and size > limit:
+                raise self._too_much_output()
+
+            if line.startswith('.error'):
+                error = line[len('.error'):].strip()
+            else:
+                yield line
+        else:
+            raise self._died()
+
+        self._busy = False
+        if error is not None:
+            raise cue_error(error)
+
+    def _read_framed(self):
+        stdout = self.proc.stdout
+        limit = self.max_output
+        size = 0
+        error = None
+
+        while True:
+            header = stdout.readline()
+            name, _, value_size = header.partition(' ')
+            if not value_size.strip().isdigit():
+                raise self._died()
+
+            # The value plus its trailing newline
+            value_size = int(value_size) + 1
+            size += len(header) + value_size
+            if limit is not None and size > limit:
+                raise self._too_much_output()
+
+            value = stdout.read(value_size)
+            if len(value) != value_size:
+                raise self._died()
+
+            if name == 'end':
+                break
+            elif name == 'error':
+                error = value[:-1]
+            else:
+                yield header + value
+
+        self._busy = False
+        if error is not None:
+            raise cue_error(error)
+
+
+_default_worker = None
+_default_worker_lock = threading.Lock()
+
+def default_worker():
+    """
+    The worker used by run_cue() and translate() when none is given: a
+    pool of one CueWorker, so threads take turns at its R process rather
+    than interleaving their requests on its pipes. Started on first use.
+    """
+    global _default_worker
+
+    with _default_worker_lock:
+        if _default_worker is None:
+            _default_worker = CuePool(1)
+            atexit.register(_default_worker.close)
+
+    return _default_worker
+
+
+_r_version = None
+
+def r_version():
+    """R's version banner from `Rscript --version`, looked up once."""
+    global _r_version
+
+    if _r_version is None:
+        try:
+            p = subprocess.Popen(['Rscript', '--version'],
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out, err = p.communicate()
+            # Older versions of Rscript print this on stderr
+            _r_version = (out + err).strip()
+        except OSError:
+            _r_version = ''
+
+    return _r_version
+
+
+class CueCache(object):
+
+    """
+    On-disk cache of cue.r record streams.
+
+    Entries are keyed on a hash of the source text, cue.r's options, cue.r
+    and the R version, so editing cue.r or upgrading R invalidates them.
+    Entries are written to a temporary file and renamed into place, so
+    readers never see a partial entry. Once the cache grows past
+    `max_bytes`, the least recently used entries are evicted; a hit
+    refreshes the entry's mtime.
+    """
+
+    def __init__(self, path, max_bytes=256 * 1024 * 1024, script=CUE_SCRIPT,
+                 version=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.script = script
+        self.version = version
+
+        self.hits = 0
+        self.misses = 0
+
+        self._salt = None
+        self._lock = threading.Lock()
+
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+
+        self._size = sum(size for path, size, mtime in self._entries())
+
+    def _entries(self):
+        for name in os.listdir(self.path):
+            if name.startswith('.'):
+                continue
+
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                # Evicted by another process
+                continue
+
+            yield path, st.st_size, st.st_mtime
+
+    def key(self, text, options=()):
+        if self._salt is None:
+            m = hashlib.sha1()
+            with open(self.script, 'rb') as fh:
+                m.update(fh.read())
+            m.update(self.version if self.version is not None else r_version())
+            self._salt = m.digest()
+
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+
+        m = hashlib.sha1(self._salt)
+        m.update(' '.join(options) + '\0')
+        m.update(text)
+        return m.hexdigest()
+
+    def get(self, text, options=()):
+        path = os.path.join(self.path, self.key(text, options))
+        try:
+            with open(path, 'rb') as fh:
+                out = fh.read()
+            os.utime(path, None)
+        except (IOError, OSError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return out
+
+    def put(self, text, out, options=()):
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='.tmp')
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(out)
+        path = os.path.join(self.path, self.key(text, options))
+
+        with self._lock:
+            # Another thread may have put the same source first
+            try:
+                replaced = os.stat(path).st_size
+            except OSError:
+                replaced = 0
+            os.rename(tmp_path, path)
+
+            self._size += len(out) - replaced
+            if self._size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        size = sum(size for path, size, mtime in entries)
+
+        for path, entry_size, mtime in entries:
+            if size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            size -= entry_size
+
+        self._size = size
+
+
+def run_cue(text, worker=None, cache=None):
+    if worker is None:
+        worker = default_worker()
+
+    if cache is not None:
+        out = cache.get(text, worker.options)
+        if out is not None:
+            return out
+
+    out = worker.run(text)
+
+    if cache is not None:
+        cache.put(text, out, worker.options)
+
+    return out
+
+
+class CuePool(object):
+
+    """
+    A fixed set of warm CueWorkers shared between threads.
+
+    run() borrows an idle worker for the duration of one request, so up to
+    `size` R processes parse concurrently. A worker whose R process dies is
+    restarted by its next request. `limits` are passed on to each
+    CueWorker: timeout, max_output, memory and cpu.
+    """
+
+    def __init__(self, size=None, script=CUE_SCRIPT, format='text',
+                 srcref=False, **limits):
+        if size is None:
+            size = multiprocessing.cpu_count()
+
+        self.size = size
+        self.format = format
+        self.options = cue_options(format, srcref)
+        self._idle = Queue.Queue()
+        for i in range(size):
+            self._idle.put(CueWorker(script, format, srcref, **limits))
+
+    def run(self, text):
+        worker = self._idle.get()
+        try:
+            return worker.run(text)
+        finally:
+            self._idle.put(worker)
+
+    def stream(self, text):
+        worker = self._idle.get()
+        chunks = worker.stream(text)
+        try:
+            for chunk in chunks:
+                yield chunk
+        finally:
+            # Ends an abandoned request before the worker is handed on
+            chunks.close()
+            self._idle.put(worker)
+
+    def close(self):
+        for i in range(self.size):
+            self._idle.get().close()
+
+
 class Transformer(ast.NodeTransformer):
 
+    """
+    Transforms a tree of CueGeneric nodes into a Python AST.
+
+    Node types and call operators are dispatched through lookup tables,
+    so each node costs one dict lookup rather than a chain of comparisons.
+    CueGeneric trees are walked from an explicit stack, so arbitrarily
+    deep R expressions don't hit Python's recursion limit.
+
+    `preamble` holds statements the translated code depends on, written
+    once at the top of each translation. Statements that only some code
+    depends on, such as the import of the promise runtime, are added to
+    `pending` by require() and written before the first top-level
+    statement that needs them.
+    """
+
+    preamble = []
+
+    def __init__(self):
+        self.pending = list(self.preamble)
+        self._required = set()
+
+    def require(self, stmt):
+        """Have `stmt`, an import, written ahead of the code being built."""
+        key = ast.dump(stmt)
+        if key not in self._required:
+            self._required.add(key)
+            self.pending.append(stmt)
+
     def visit_CueGeneric(self, node):
+        return self.transform(node)
+
+    def transform(self, root):
+        """
+        Transform a CueGeneric tree bottom-up, without recursion.
+
+        The tree is first flattened from an explicit stack; reversed, that
+        order has every node's subtrees, left to right, before the node
+        itself. Each node then pops its children's results off the `done`
+        stack and hands them to its type handler.
+        """
+        order = []
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            order.append(node)
+            stack.extend(node.children)
+
+        handlers = self._type_handlers
+        done = []
+
+        for node in reversed(order):
+            count = len(node.children)
+            if count:
+                children = done[-count:]
+                del done[-count:]
+            else:
+                children = []
+
+            try:
+                handler = handlers[node.type]
+            except KeyError:
+                raise UnknownError(node.type)
+
+            done.append(handler(self, node, children))
+
+        return done[0]
+
+    def _symbol(self, node, children):
+        return self.symbol(node.content)
 
-        if node.type == 'symbol':
-            newnode = CueSymbol(node.content)
-
-        elif node.type == 'language':
-            newnode = CueLanguage(node.children)
-
-        elif node.type == 'expression':
-            newnode = CueExpression(node.children)
-
-        elif node.type == 'NULL':
-            newnode = CueNull()
-
-        elif node.type == 'double':
-            # TODO could be float()?
-            newnode = ast.Num(int(node.content))
-
-        elif node.type == 'pairlist':
-            newnode = CuePairlist(node.recs)
-
-        elif node.type == 'character':
-            newnode = ast.Str(node.content)
-
-        return self.visit(newnode)
-
-    def visit_CueExpression(self, node):
-        body = [self.visit(child) for child in node.children]
-        return ast.Module(body)
-
-    def visit_CueSymbol(self, node):
-        op_str = node.content
-
-        op_map = {
-            # Binary
-            '<-': CueAssignOp,
-            '=': CueAssignOp,
-            '*': ast.Mult,
-            # TODO this probably isn't true, unless __future__.division is always
-            #      imported. R also has '%/%' for integer division
-            '/': ast.Div,
-            '+': ast.Add,
-            '-': ast.Sub,
-            '%%': ast.Mod,
-            '^': ast.Pow,
-            '**': ast.Pow,
-
-            # Comparison
-            '<': ast.Lt,
-            '<=': ast.LtE,
-            '>': ast.Gt,
-            '>=': ast.GtE,
-            '==': ast.Eq,
-            '!=': ast.NotEq,
-            '%in%': ast.In,
-            # R doesn't have a simple equivalent to 'is'
-            # http://stackoverflow.com/questions/10912729/r-object-identity
-
-            # Unary
-            '!': ast.Not,
-
-            # Boolean
-            # TODO there's a difference between vectorized and not
-            # TODO not handling the vectorized ops '&', '|', etc.
-            '&&': ast.And,
-            '||': ast.Or,
-
-            # Indexing
-            '[[': ast.Subscript,
-
-            # Other
-            'function': CueFunctionOp,
-            'if': CueIfOp,
-            '{': CueBlockOp,
-            '(': CueParenOp,
-            'return': CueReturnOp,
-        }
+    def _language(self, node, children):
+        return self.language(children)
 
+    def _expression(self, node, children):
+        return ast.Module([as_statement(child) for child in children])
+
+    def _null(self, node, children):
+        return CueNull()
+
+    def _double(self, node, children):
+        # TODO could be float()?
+        return ast.Num(int(node.content))
+
+    def _pairlist(self, node, children):
+        # Each argument's default follows as a child; the empty symbol
+        # stands for no default. Older dumps have no children.
+        defaults = None
+        if children:
+            defaults = []
+            for child, default in zip(node.children, children):
+                if child.type == 'symbol' and not child.content:
+                    default = None
+                elif isinstance(default, CueNull):
+                    default = ast.Name('None', ast.Load())
+                defaults.append(default)
+
+        return CuePairlist(node.recs, defaults)
+
+    def _character(self, node, children):
+        return ast.Str(node.content)
+
+    _logicals = {'TRUE': 'True', 'FALSE': 'False', 'NA': 'None'}
+
+    def _logical(self, node, children):
+        return ast.Name(self._logicals[node.content], ast.Load())
+
+    _type_handlers = {
+        'symbol': _symbol,
+        'language': _language,
+        'expression': _expression,
+        'NULL': _null,
+        'double': _double,
+        'pairlist': _pairlist,
+        'character': _character,
+        'logical': _logical,
+    }
+
+    def symbol(self, op_str):
         try:
-            return op_map[op_str]()
+            return symbols[op_str]
         except KeyError:
             return ast.Name(op_str, ast.Load())
 
-
-    def visit_CueLanguage(self, node):
-        children = [self.visit(child) for child in node.children]
+    def language(self, children):
+        """Build the node for a call, given its already visited children."""
         assert len(children) > 0
 
         op = children[0]
         rest = children[1:]
 
-        if isinstance(op, ast.operator):
-            assert len(rest) == 2
-            left, right = rest
+        try:
+            handler = self._language_handlers[op.__class__]
+        except KeyError:
+            raise UnknownError(op)
 
-            # Assignment is special in R because it could either be 
-            # simple assignment, or a function definition, or ...
-            if isinstance(op, CueAssignOp):
-                newnode = CueAssign(left, right)
-            else:
-                newnode = ast.BinOp(left, op, right)
+        return handler(self, op, rest)
 
-        elif isinstance(op, ast.cmpop):
-            assert len(rest) == 2
-            left, right = rest
-            newnode = ast.Compare(left, [op], [right])
 
-        elif isinstance(op, ast.unaryop):
-            assert len(rest) == 1
-            operand = rest[0]
-            newnode = ast.UnaryOp(op, operand)
+    def _assign(self, op, rest):
+        assert len(rest) == 2
+        left, right = rest
 
-        elif isinstance(op, ast.boolop):
-            assert len(rest) == 2
-            left, right = rest
-            newnode = ast.BoolOp(op, [left, right])
+        # Assignment is special in R because it could either be 
+        # simple assignment, or a function definition, or ...
+        return self.visit_CueAssign(CueAssign(left, right))
 
-        elif isinstance(op, CueFunctionOp):
-            assert len(rest) == 3
-            args, body, dontknow = rest
-            newnode = CueFunction(args, body, dontknow)
+    def _binop(self, op, rest):
+        if len(rest) == 1 and op.__class__ in self._unary_arith:
+            return ast.UnaryOp(self._unary_arith[op.__class__], rest[0])
 
-        elif isinstance(op, CueIfOp):
-            assert len(rest) == 2
-            cond, body = rest
+        assert len(rest) == 2
+        left, right = rest
+        return ast.BinOp(left, op, right)
 
-            if isinstance(body, ast.expr):
-                body = ast.Expr(body)
-            elif isinstance(body, CueBody):
-                body = [ast.Expr(e) for e in body.exprs]
+    # Binary operators that R also uses as unary ones, as in -1
+    _unary_arith = {ast.Sub: ast.USub(), ast.Add: ast.UAdd()}
 
-            newnode = ast.If(rest[0], body, None)
+    def _compare(self, op, rest):
+        assert len(rest) == 2
+        left, right = rest
+        return ast.Compare(left, [op], [right])
 
-        elif isinstance(op, CueBlockOp):
-            newnode = CueBody(rest)
+    def _unaryop(self, op, rest):
+        assert len(rest) == 1
+        operand = rest[0]
+        return ast.UnaryOp(op, operand)
 
-        elif isinstance(op, CueParenOp):
-            print rest
-            newnode = rest[0]
+    def _boolop(self, op, rest):
+        assert len(rest) == 2
+        left, right = rest
+        return ast.BoolOp(op, [left, right])
 
-        elif isinstance(op, CueReturnOp):
-            if not rest:
-                newnode = ast.Return(value=None)
-            else:
-                assert len(rest) == 1
-                value = rest[0]
-                newnode = ast.Return(value=value)
+    def _function(self, op, rest):
+        assert len(rest) == 3
+        args, body, dontknow = rest
+        return self.visit_CueFunction(CueFunction(args, body, dontknow))
 
-        elif isinstance(op, ast.Subscript):
-            assert len(rest) == 2
-            op.value, op.slice = rest
-            newnode = op
+    def _if(self, op, rest):
+        assert len(rest) in (2, 3)
+        cond, body = rest[:2]
 
-        elif isinstance(op, ast.Name) or isinstance(op, ast.Call):
-            # TODO this allows invalid function names,
-            #      such as 'read.csv'
+        if isinstance(body, ast.expr):
+            body = ast.Expr(body)
+        elif isinstance(body, CueBody):
+            body = self.statements(body)
 
-            # TODO wouldn't support foo(1)(2)
+        orelse = None
+        if len(rest) == 3:
+            orelse = self.statements(rest[2])
 
-            args = []
-            for r in rest:
-                assert isinstance(r, ast.expr)
-                args.append(r)
+        return ast.If(cond, body, orelse)
 
-            newnode = ast.Call(op, args, [], None, None)
+    def _block(self, op, rest):
+        return CueBody(rest)
 
-        else:
-            raise UnknownError(op)
+    def _paren(self, op, rest):
+        return rest[0]
+
+    def _return(self, op, rest):
+        if not rest:
+            return ast.Return(value=None)
+
+        assert len(rest) == 1
+        value = rest[0]
+        return ast.Return(value=value)
 
-        return self.visit(newnode)
+    def _index(self, op, rest):
+        assert len(rest) >= 2
+        value = rest[0]
+        indices = [self.index(index) for index in rest[1:]]
+        if len(indices) == 1:
+            index = indices[0]
+        else:
+            # m[i, j], or df[, j]
+            index = ast.ExtSlice(indices)
+        return ast.Subscript(value, index, ast.Load())
+
+    def _for(self, op, rest):
+        assert len(rest) == 3
+        var, seq, body = rest
+        return self.loop(var.id, seq, self.statements(body))
+
+    def _range(self, op, rest):
+        assert len(rest) == 2
+        start, stop = rest
+        return self.sequence(start, stop)
+
+    def _call(self, op, rest):
+        # TODO this allows invalid function names,
+        #      such as 'read.csv'
+
+        if isinstance(op, ast.Name):
+            handler = self._call_handlers.get(op.id)
+            if handler is not None:
+                node = handler(self, rest)
+                if node is not None:
+                    return node
+
+        args = []
+        for r in rest:
+            assert isinstance(r, ast.expr)
+            args.append(r)
+
+        return ast.Call(op, args, [], None, None)
+
+    _language_handlers = op_handlers([
+        (CueAssignOp, _assign),
+        (ast.operator, _binop),
+        (ast.cmpop, _compare),
+        (ast.unaryop, _unaryop),
+        (ast.boolop, _boolop),
+        (CueFunctionOp, _function),
+        (CueIfOp, _if),
+        (CueForOp, _for),
+        (CueBlockOp, _block),
+        (CueParenOp, _paren),
+        (CueReturnOp, _return),
+        (CueIndexOp, _index),
+        (CueRangeOp, _range),
+    ])
+    _language_handlers.update({
+        ast.Name: _call,
+        ast.Call: _call,
+        ast.Subscript: _call,
+    })
+
+
+    def statements(self, body):
+        """
+        The statements of a loop body: one expression, or a block. An
+        empty block is a `pass`, as Python needs a body.
+        """
+        if isinstance(body, CueBody):
+            body = body.exprs
+        else:
+            body = [body]
+        return ([n if isinstance(n, ast.stmt) else ast.Expr(n) for n in body]
+                or [ast.Pass()])
+
+    def loop(self, name, seq, body):
+        """for (name in seq) body"""
+        return ast.For(ast.Name(name, ast.Store()), seq, body, [])
+
+    def sequence(self, start, stop):
+        """R's start:stop, and seq_len() and seq_along()."""
+        stop = ast.BinOp(stop, ast.Add(), ast.Num(1))
+        return ast.Call(ast.Name('range', ast.Load()), [start, stop],
+                        [], None, None)
+
+    def simplify(self, node):
+        """The result of sapply(), given the list comprehension."""
+        return node
+
+    def index(self, node):
+        """
+        An R index, which counts from 1, as a Python one: `i` becomes
+        `i - 1`, a:b the slice a-1:b, and an empty index, as in df[, 1],
+        the whole slice. A logical index is a mask, and a name, as in
+        x[["a"]], is left as it is. A constant negative index, which drops
+        elements in R, raises UnknownError; other negative indices aren't
+        detected.
+        """
+        if isinstance(node, ast.Name) and not node.id:
+            return ast.Slice(None, None, None)
+        if _is_logical(node) or isinstance(node, ast.Str):
+            return node
+
+        n = _number(node)
+        if n is not None:
+            if n < 0:
+                raise UnknownError('negative index {}'.format(n))
+            return ast.Num(n - 1)
+
+        if isinstance(node, ast.Call) and len(node.args) == 2 and (
+                isinstance(node.func, ast.Name) and node.func.id == 'range' or
+                isinstance(node.func, ast.Attribute) and
+                node.func.attr == 'arange'):
+            # sequence(), whose stop is one past R's
+            start, stop = node.args
+            return ast.Slice(_offset(start, -1), _offset(stop, -1), None)
+
+        return _offset(node, -1)
+
+    def comprehension(self, func, seqs, extra):
+        """
+        Map `func` over `seqs` in parallel, passing `extra` arguments after
+        the elements: a list comprehension over a function literal with a
+        single expression body, otherwise a map() or a comprehension
+        calling `func`. Returns None for anything else, such as a function
+        literal with several statements, which is left as a call.
+        """
+        if isinstance(func, ast.FunctionDef):
+            params = func.args.args if func.args else []
+            if extra or len(params) != len(seqs) or len(func.body) != 1:
+                return None
+            stmt = func.body[0]
+            if not isinstance(stmt, (ast.Expr, ast.Return)) or \
+                    stmt.value is None:
+                return None
+            elt = stmt.value
+            names = [param.id for param in params]
+        elif not extra:
+            return ast.Call(ast.Name('map', ast.Load()), [func] + seqs,
+                            [], None, None)
+        else:
+            # R names can't start with an underscore, so these can't
+            # shadow anything
+            names = ['_x{}'.format(i) for i in range(len(seqs))]
+            args = [ast.Name(name, ast.Load()) for name in names]
+            elt = ast.Call(func, args + extra, [], None, None)
+
+        if len(seqs) == 1:
+            target = ast.Name(names[0], ast.Store())
+            seq = seqs[0]
+        else:
+            target = ast.Tuple([ast.Name(name, ast.Store())
+                                for name in names], ast.Store())
+            seq = ast.Call(ast.Name('zip', ast.Load()), seqs, [], None, None)
+
+        return ast.ListComp(elt, [ast.comprehension(target, seq, [])])
+
+    def _lapply(self, args):
+        if len(args) < 2:
+            return None
+        return self.comprehension(args[1], args[:1], args[2:])
+
+    def _sapply(self, args):
+        node = self._lapply(args)
+        if node is not None:
+            node = self.simplify(node)
+        return node
+
+    def _vapply(self, args):
+        # vapply(X, FUN, FUN.VALUE, ...): the template only checks types
+        if len(args) < 3:
+            return None
+        node = self.comprehension(args[1], args[:1], args[3:])
+        if node is not None:
+            node = self.simplify(node)
+        return node
+
+    def _mapply(self, args):
+        # Argument names aren't kept, so MoreArgs and SIMPLIFY can't be
+        # told apart from vectors to map over
+        if len(args) < 2:
+            return None
+        node = self.comprehension(args[0], args[1:], [])
+        if node is not None:
+            node = self.simplify(node)
+        return node
+
+    def _seq_len(self, args):
+        if len(args) != 1:
+            return None
+        return self.sequence(ast.Num(1), args[0])
+
+    def _seq_along(self, args):
+        if len(args) != 1:
+            return None
+        length = ast.Call(ast.Name('len', ast.Load()), args, [], None, None)
+        return self.sequence(ast.Num(1), length)
+
+    # Calls to these R functions are rewritten, if their handler returns
+    # a node
+    _call_handlers = {
+        'lapply': _lapply,
+        'sapply': _sapply,
+        'vapply': _vapply,
+        'mapply': _mapply,
+        'seq_len': _seq_len,
+        'seq_along': _seq_along,
+    }
 
 
     def visit_CueAssign(self, node):
+        if isinstance(node.left, ast.Subscript):
+            node.left.ctx = ast.Store()
+            return ast.Assign([node.left], node.right)
+
         newleft = ast.Name(node.left.id, ast.Store())
 
         if isinstance(node.right, ast.FunctionDef):
@@ -286,11 +1142,6 @@ class Transformer(ast.NodeTransformer):
     def visit_CueFunction(self, node):
         arguments = []
 
-        if isinstance(node.args, CuePairlist):
-            argslist = node.args.argslist
-            args = [ast.Name(name, ast.Param()) for name, value, type_ in argslist]
-            arguments = ast.arguments(args, None, None, [])
-
         body = []
         for n in node.body:
             if isinstance(n, ast.stmt):
@@ -299,11 +1150,72 @@ class Transformer(ast.NodeTransformer):
                 n = ast.Expr(n)
                 body.append(n)
             elif isinstance(n, CueBody):
-                for expr in n.exprs:
-                    body.append(ast.Expr(expr))
+                body.extend(self.statements(n))
+
+        if isinstance(node.args, CuePairlist):
+            argslist = node.args.argslist
+            args = [ast.Name(name, ast.Param()) for name, value, type_ in argslist]
+            names = [name for name, value, type_ in argslist]
+            defaults, prologue = self.defaults(names, node.args.defaults, body)
+            arguments = ast.arguments(args, None, None, defaults)
+            body = prologue + body
 
         return ast.FunctionDef(None, arguments, body, [])
 
+    def defaults(self, names, defaults, body):
+        """
+        Translate the defaults of arguments `names`, returning the Python
+        defaults and the statements to put at the top of the function.
+
+        R evaluates a default lazily, in the function's frame, and only if
+        the argument is used. A constant default, including a signed
+        number, is simply a Python default. Any other has the MISSING default instead, and is bound to
+        a promise of its expression if the caller left it out; reads of
+        the argument in `body`, and in the other defaults, then force it
+        (see promise.py). Arguments after the first default that have none
+        also default to MISSING, as Python requires.
+        """
+        python_defaults = []
+        lazy = []
+        missing = False
+        for name, default in zip(names, defaults):
+            if default is None:
+                if python_defaults:
+                    python_defaults.append(ast.Name('MISSING', ast.Load()))
+                    missing = True
+            elif is_constant(default):
+                python_defaults.append(default)
+            elif _number(default) is not None:
+                # A signed number, such as -1
+                python_defaults.append(ast.Num(_number(default)))
+            else:
+                python_defaults.append(ast.Name('MISSING', ast.Load()))
+                lazy.append((name, default))
+
+        if not lazy:
+            if missing:
+                self.require(_import_missing)
+            return python_defaults, []
+
+        self.require(_import_promise)
+
+        lazy_names = set(name for name, default in lazy)
+        _force_reads(body, lazy_names)
+
+        prologue = []
+        for name, default in lazy:
+            default = _force_reads([default], lazy_names)[0]
+            thunk = ast.Lambda(ast.arguments([], None, None, []), default)
+            promise = ast.Call(ast.Name('Promise', ast.Load()), [thunk],
+                               [], None, None)
+            prologue.append(ast.If(
+                ast.Compare(ast.Name(name, ast.Load()), [ast.Is()],
+                            [ast.Name('MISSING', ast.Load())]),
+                [ast.Assign([ast.Name(name, ast.Store())], promise)],
+                []))
+
+        return python_defaults, prologue
+
 
     def visit_CueAdd(self, node):
         return ast.BinOp(node.left, ast.Add(), node.right)
@@ -313,28 +1225,948 @@ class Transformer(ast.NodeTransformer):
         return ast.BinOp(node.left, ast.Mult(), node.right)
 
 
-def translate_cue_code(cue_code):
-    nodes = reader(cue_code.split('\n'), CueGeneric)
-    root = nodes.next()
+_import_missing = ast.ImportFrom('promise', [ast.alias('MISSING', None)], 0)
+_import_promise = ast.ImportFrom(
+    'promise', [ast.alias(name, None)
+                for name in ('MISSING', 'Promise', 'force')], 0)
 
-    tree = Transformer().visit(root)
 
-    print ast.dump(tree)
+def _force_reads(nodes, names):
+    """
+    Wrap each read of a variable in `names` within `nodes` in a call to
+    force(). Returns `nodes`, with any that were such a read replaced.
+    """
+    def wrap(value):
+        if isinstance(value, ast.Name) and value.id in names and \
+                isinstance(value.ctx, ast.Load):
+            return ast.Call(ast.Name('force', ast.Load()), [value],
+                            [], None, None)
+        return value
+
+    nodes = [wrap(node) for node in nodes]
+    for parent in [n for node in nodes for n in ast.walk(node)]:
+        for field, value in ast.iter_fields(parent):
+            if isinstance(value, list):
+                setattr(parent, field, [wrap(item) for item in value])
+            elif isinstance(value, ast.AST):
+                setattr(parent, field, wrap(value))
+    return nodes
+
+
+# NumPy functions giving logical vectors
+_logical_ufuncs = frozenset([
+    'less', 'less_equal', 'greater', 'greater_equal', 'equal', 'not_equal',
+    'logical_and', 'logical_or', 'logical_xor', 'logical_not', 'isnan',
+    'isin'])
+
+def _is_logical(node):
+    """Whether `node` is a comparison or logical expression."""
+    if isinstance(node, (ast.Compare, ast.BoolOp)):
+        return True
+    if isinstance(node, ast.UnaryOp):
+        return isinstance(node.op, ast.Not)
+    if isinstance(node, ast.Name):
+        return node.id in ('True', 'False')
+    return (isinstance(node, ast.Call) and
+            isinstance(node.func, ast.Attribute) and
+            isinstance(node.func.value, ast.Name) and
+            node.func.value.id == 'np' and
+            node.func.attr in _logical_ufuncs)
+
+
+def _number(node):
+    """The value of a number literal, with any sign, or None."""
+    sign = 1
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub,
+                                                              ast.UAdd)):
+        sign = -1 if isinstance(node.op, ast.USub) else 1
+        node = node.operand
+    elif (isinstance(node, ast.Call) and
+          isinstance(node.func, ast.Attribute) and
+          isinstance(node.func.value, ast.Name) and
+          node.func.value.id == 'np' and
+          node.func.attr in ('negative', 'positive') and
+          len(node.args) == 1):
+        sign = -1 if node.func.attr == 'negative' else 1
+        node = node.args[0]
+
+    if isinstance(node, ast.Num):
+        return sign * node.n
+    return None
+
+
+def _offset(node, n):
+    """
+    `node + n`, folded into a constant, or into a constant already added
+    to or subtracted from `node`, as in the index x[i - 1].
+    """
+    if isinstance(node, ast.Num):
+        return ast.Num(node.n + n)
 
-    out = StringIO()
+    base, k = node, 0
+    if isinstance(node, ast.BinOp) and isinstance(node.right, ast.Num):
+        if isinstance(node.op, ast.Add):
+            base, k = node.left, node.right.n
+        elif isinstance(node.op, ast.Sub):
+            base, k = node.left, -node.right.n
+    elif (isinstance(node, ast.Call) and
+          isinstance(node.func, ast.Attribute) and
+          len(node.args) == 2 and isinstance(node.args[1], ast.Num)):
+        if node.func.attr == 'add':
+            base, k = node.args[0], node.args[1].n
+        elif node.func.attr == 'subtract':
+            base, k = node.args[0], -node.args[1].n
+
+    k += n
+    if k > 0:
+        return ast.BinOp(base, ast.Add(), ast.Num(k))
+    if k < 0:
+        return ast.BinOp(base, ast.Sub(), ast.Num(-k))
+    return base
+
+
+def _np(name):
+    return ast.Attribute(ast.Name('np', ast.Load()), name, ast.Load())
+
+
+class NumpyTransformer(Transformer):
+
+    """
+    A Transformer targeting NumPy, for numeric code.
+
+    R's arithmetic, comparison and logical operators work elementwise on
+    vectors, so they are translated to the NumPy ufuncs, which do the same
+    over arrays and broadcast scalars. '&' and '|' become np.logical_and and
+    np.logical_or, while '&&' and '||' stay Python's scalar `and` and `or`.
+    Vectorized R functions such as sqrt() and sum() call their NumPy
+    equivalents, and c() builds an array.
+
+    sapply() and friends build arrays from their comprehensions, and
+    elementwise for loops are replaced by array expressions where that's
+    safe (see vectorize()).
+    """
+
+    preamble = [ast.Import([ast.alias('numpy', 'np')])]
+
+    # Operator classes from `symbols`, with their binary and unary ufuncs
+    _op_ufuncs = {
+        ast.Add: ('add', 'positive'),
+        ast.Sub: ('subtract', 'negative'),
+        ast.Mult: ('multiply', None),
+        # R's / always gives a double, as np.true_divide does
+        ast.Div: ('true_divide', None),
+        ast.Mod: ('mod', None),
+        # R's numbers are doubles, and np.power raises on an integer to a
+        # negative integer power
+        ast.Pow: ('float_power', None),
+        ast.Lt: ('less', None),
+        ast.LtE: ('less_equal', None),
+        ast.Gt: ('greater', None),
+        ast.GtE: ('greater_equal', None),
+        ast.Eq: ('equal', None),
+        ast.NotEq: ('not_equal', None),
+        ast.In: ('isin', None),
+        ast.Not: (None, 'logical_not'),
+    }
+
+    # R functions of one argument that are called as the NumPy function of
+    # the given name. Given more arguments, they are left as they are: R's
+    # max(x, 0) is the largest of x and 0, where np.max(x, 0) takes 0 as
+    # the axis, and an argument such as na.rm = TRUE can't be told apart
+    # once its name is dropped.
+    _functions = {
+        'abs': 'abs',
+        'sqrt': 'sqrt',
+        'exp': 'exp',
+        'log': 'log',
+        'log2': 'log2',
+        'log10': 'log10',
+        'log1p': 'log1p',
+        'sin': 'sin',
+        'cos': 'cos',
+        'tan': 'tan',
+        'floor': 'floor',
+        'ceiling': 'ceil',
+        'trunc': 'trunc',
+        'sum': 'sum',
+        'prod': 'prod',
+        'mean': 'mean',
+        'max': 'max',
+        'min': 'min',
+        'cumsum': 'cumsum',
+        'cumprod': 'cumprod',
+        'length': 'size',
+        'is.na': 'isnan',
+    }
+
+    # R functions of two vectors, likewise
+    _binary_functions = {
+        '&': 'logical_and',
+        '|': 'logical_or',
+        'xor': 'logical_xor',
+        'pmax': 'maximum',
+        'pmin': 'minimum',
+    }
+
+    # The NumPy functions above that work elementwise, so a loop calling
+    # only these can be vectorized
+    _elementwise = frozenset(
+        name for pair in _op_ufuncs.values() for name in pair if name)
+    _elementwise |= frozenset(
+        name for name in _functions.values()
+        if name not in ('sum', 'prod', 'mean', 'max', 'min', 'cumsum',
+                        'cumprod', 'size'))
+    _elementwise |= frozenset(_binary_functions.values())
+
+    def language(self, children):
+        op = children[0]
+        rest = children[1:]
+
+        ufuncs = self._op_ufuncs.get(op.__class__)
+        if ufuncs is not None and 1 <= len(rest) <= 2:
+            name = ufuncs[len(rest) == 1]
+            if name is not None:
+                return ast.Call(_np(name), rest, [], None, None)
+
+        if isinstance(op, ast.Name):
+            if op.id == 'c':
+                return self.vector(rest)
+
+            name = None
+            if len(rest) == 1:
+                name = self._functions.get(op.id)
+            elif len(rest) == 2:
+                name = self._binary_functions.get(op.id)
+                if op.id == 'log':
+                    # log(x, base)
+                    return ast.Call(_np('true_divide'),
+                                    [ast.Call(_np('log'), [arg], [], None, None)
+                                     for arg in rest], [], None, None)
+            if name is not None:
+                return ast.Call(_np(name), rest, [], None, None)
+
+        return Transformer.language(self, children)
+
+    def sequence(self, start, stop):
+        stop = ast.BinOp(stop, ast.Add(), ast.Num(1))
+        return ast.Call(_np('arange'), [start, stop], [], None, None)
+
+    def simplify(self, node):
+        return ast.Call(_np('array'), [node], [], None, None)
+
+    def loop(self, name, seq, body):
+        vectorized = self.vectorize(name, seq, body)
+        if vectorized is not None:
+            return vectorized
+        return Transformer.loop(self, name, seq, body)
+
+    def vectorize(self, name, seq, body):
+        """
+        Rewrite an elementwise loop as one array expression:
+
+            for (i in seq) y[i] <- f(x[i], 2)  =>  y[seq - 1] = f(x[seq - 1], 2)
+
+        The index is written as index() writes it, so a start:stop range is
+        the slice start-1:stop. This is only done when the body is that one
+        assignment, `i` is only used to index a vector, `y` isn't otherwise
+        read, and every call is to an elementwise ufunc, so the iterations
+        are independent and NumPy's fancy indexing does them all at once.
+        `seq` must be a variable or a start:stop range, which are cheap to
+        evaluate twice, and if it's a variable `y` can't be read at all.
+        Returns None if the loop doesn't qualify.
+
+        Unlike the loop, this leaves `i` unset afterwards.
+        """
+        if len(body) != 1 or not isinstance(body[0], ast.Assign):
+            return None
+        assign = body[0]
+        target = assign.targets[0]
+        if not (len(assign.targets) == 1 and self._indexed(target, name)):
+            return None
+        if not self._simple(seq):
+            return None
+
+        index = self.index(seq)
+        value = self._substitute(assign.value, name, target.value.id, index)
+        if value is None:
+            return None
+
+        # A variable may repeat an index, which the loop would then update
+        # twice, reading its own result
+        if not isinstance(seq, ast.Call) and any(
+                isinstance(node, ast.Name) and node.id == target.value.id
+                for node in ast.walk(assign.value)):
+            return None
+
+        return ast.Assign(
+            [ast.Subscript(target.value, index, ast.Store())], value)
+
+    @staticmethod
+    def _indexed(node, name):
+        """Whether `node` is v[name], as index() writes it, for a variable v."""
+        if not isinstance(node, ast.Subscript):
+            return False
+        index = node.slice
+        return (isinstance(node.value, ast.Name) and
+                isinstance(index, ast.BinOp) and
+                isinstance(index.op, ast.Sub) and
+                isinstance(index.left, ast.Name) and index.left.id == name and
+                isinstance(index.right, ast.Num) and index.right.n == 1)
+
+    def _simple(self, seq):
+        if isinstance(seq, (ast.Name, ast.Num)):
+            return True
+        if isinstance(seq, ast.BinOp):
+            return self._simple(seq.left) and self._simple(seq.right)
+        return (isinstance(seq, ast.Call) and
+                isinstance(seq.func, ast.Attribute) and
+                seq.func.attr == 'arange' and
+                all(self._simple(arg) for arg in seq.args))
+
+    def _substitute(self, node, name, target, index):
+        """
+        `node` with each v[name] replaced by v[index], or None if it isn't
+        elementwise in `name`, or reads `target` other than at `name`.
+        """
+        if self._indexed(node, name):
+            return ast.Subscript(node.value, index, ast.Load())
+        if isinstance(node, ast.Name):
+            if node.id in (name, target):
+                return None
+            return node
+        if isinstance(node, (ast.Num, ast.Str)):
+            return node
+        if (isinstance(node, ast.Call) and
+                isinstance(node.func, ast.Attribute) and
+                node.func.attr in self._elementwise and
+                not node.keywords and node.starargs is None and
+                node.kwargs is None):
+            args = [self._substitute(arg, name, target, index)
+                    for arg in node.args]
+            if None in args:
+                return None
+            return ast.Call(node.func, args, [], None, None)
+        return None
+
+    def vector(self, items):
+        """
+        c(...). Constants are written out as np.array([...]); anything else
+        may itself be a vector, which c() flattens into the result, as
+        np.hstack does.
+        """
+        func = 'hstack'
+        if all(isinstance(item, (ast.Num, ast.Str)) for item in items):
+            func = 'array'
+        return ast.Call(_np(func), [ast.List(items, ast.Load())],
+                        [], None, None)
+
+
+def _write_pending(transformer, out):
+    """Write the statements the transformer's output so far depends on."""
+    for stmt in transformer.pending:
+        Unparser(stmt, out)
+    del transformer.pending[:]
+
+
+def as_statement(tree):
+    """
+    `tree`, a top-level expression wrapped as a statement if need be, so
+    that it's written on a line of its own.
+    """
+    if isinstance(tree, ast.expr):
+        return ast.Expr(tree)
+    return tree
+
+
+def _unparse(transformer, tree, out, optimizer=None):
+    """
+    Write `tree`, built by `transformer`, after running it through
+    `optimizer` if there is one.
+    """
+    _write_pending(transformer, out)
+    tree = as_statement(tree)
+    if optimizer is not None:
+        tree = optimizer.optimize(tree)
+        if tree is None:
+            return
     Unparser(tree, out)
+
+
+def translate_cue_code(cue_code, format='text', transformer=Transformer,
+                       optimize=False):
+    root = read_tree(cue_code, CueGeneric, format)
+
+    transformer = transformer()
+    tree = transformer.visit(root)
+
+    out = StringIO()
+    _unparse(transformer, tree, out, Optimizer() if optimize else None)
     return out.getvalue()
 
 
-def translate(raw):
-    cue_out = run_cue(raw)
-    print cue_out
-    return translate_cue_code(cue_out)
-    
+def translate_cue_file(path, out, format='text', transformer=Transformer,
+                       optimize=False):
+    """
+    Translate a saved cue.r dump into the file object `out`.
+
+    The dump is memory-mapped, and each top-level expression is translated
+    and written as soon as its subtree has been read, then dropped. Memory
+    use follows the largest top-level expression, not the size of the dump.
+    """
+    transformer = transformer()
+    optimizer = Optimizer() if optimize else None
+    _write_pending(transformer, out)
+
+    with map_file(path) as buf:
+        for node in read_subtrees(buf, CueGeneric, format=format):
+            _unparse(transformer, transformer.visit(node), out, optimizer)
+
+
+class TranslateStats(object):
+
+    """
+    Where one translation spent its time, and how much it handled.
+
+    `times` holds the wall time spent in each stage, in seconds:
+
+      r          waiting for cue.r's output, including R starting up
+      read       grouping records into node trees
+      transform  building the Python AST, and optimizing it
+      unparse    writing Python source
+
+    When output is streamed, R runs alongside the other stages, so `total`
+    can be less than the sum of the stage times.
+    """
+
+    stages = ('r', 'read', 'transform', 'unparse')
+
+    def __init__(self):
+        self.times = dict.fromkeys(self.stages, 0.0)
+        self.total = 0.0
+        self.cached = False
+        self.source_bytes = 0
+        self.cue_bytes = 0
+        self.records = 0
+        self.nodes = 0
+        self.expressions = 0
+        self.output_bytes = 0
+
+    def as_dict(self):
+        d = dict(('{}_time'.format(stage), self.times[stage])
+                 for stage in self.stages)
+        d.update(total_time=self.total,
+                 cached=self.cached,
+                 source_bytes=self.source_bytes,
+                 cue_bytes=self.cue_bytes,
+                 records=self.records,
+                 nodes=self.nodes,
+                 expressions=self.expressions,
+                 output_bytes=self.output_bytes)
+        return d
+
+    def log(self, logger=log, level=logging.INFO):
+        """
+        Log the stats as one line of key=value pairs. They are also
+        attached to the record as `cue_stats`, for structured handlers.
+        """
+        d = self.as_dict()
+        message = ' '.join('{}={}'.format(key, d[key]) for key in sorted(d))
+        logger.log(level, 'translate %s', message, extra={'cue_stats': d})
+
+    def __repr__(self):
+        times = ' '.join('{}={:.6f}'.format(stage, self.times[stage])
+                         for stage in self.stages)
+        return '<TranslateStats total={:.6f} {} nodes={}>'.format(
+            self.total, times, self.nodes)
+
+
+class _CountingFile(object):
+
+    """Passes writes through to `f`, counting the bytes."""
+
+    def __init__(self, f):
+        self.f = f
+        self.count = 0
+
+    def write(self, text):
+        self.count += len(text)
+        self.f.write(text)
+
+    def flush(self):
+        self.f.flush()
+
+
+def _timed_chunks(chunks, stats):
+    """Yield from the worker's output stream, timing the waits on R."""
+    times = stats.times
+    it = iter(chunks)
+    while True:
+        start = time.time()
+        try:
+            chunk = it.next()
+        except StopIteration:
+            times['r'] += time.time() - start
+            return
+        times['r'] += time.time() - start
+        stats.cue_bytes += len(chunk)
+        yield chunk
+
+
+def _translate_timed(raw, out, worker, cache, stats, transformer,
+                     optimizer):
+    start = time.time()
+    times = stats.times
+    stats.source_bytes = len(raw)
+
+    cue_out = None
+    stream = None
+    if cache is not None:
+        cue_out = cache.get(raw, worker.options)
+        stats.cached = cue_out is not None
+
+    if cue_out is not None:
+        stats.cue_bytes = len(cue_out)
+    elif cache is not None:
+        cue_out = worker.run(raw)
+        cache.put(raw, cue_out, worker.options)
+        times['r'] = time.time() - start
+        stats.cue_bytes = len(cue_out)
+    else:
+        stream = worker.stream(raw)
+        cue_out = _timed_chunks(stream, stats)
+
+    try:
+        _translate_chunks(cue_out, out, worker, stats, transformer,
+                          optimizer)
+    finally:
+        # A failed translation mustn't leave the stream suspended: it
+        # holds its worker until it's closed
+        if stream is not None:
+            stream.close()
+
+    stats.total = time.time() - start
+
+
+def _translate_chunks(cue_out, out, worker, stats, transformer, optimizer):
+    times = stats.times
+    out = _CountingFile(out)
+    _write_pending(transformer, out)
+    subtrees = read_subtrees(cue_out, CueGeneric, format=worker.format)
+
+    while True:
+        # Reading pulls on the worker's output, so time spent waiting on
+        # R is taken back out of the read stage.
+        t0 = time.time()
+        r_before = times['r']
+        try:
+            node = subtrees.next()
+        except StopIteration:
+            times['read'] += time.time() - t0 - (times['r'] - r_before)
+            break
+
+        stack = [node]
+        while stack:
+            n = stack.pop()
+            stats.nodes += 1
+            # .level and .type aren't kept in recs
+            stats.records += len(n.recs) + 2
+            stack.extend(n.children)
+
+        t1 = time.time()
+        times['read'] += t1 - t0 - (times['r'] - r_before)
+
+        tree = as_statement(transformer.visit(node))
+        if optimizer is not None:
+            tree = optimizer.optimize(tree)
+        t2 = time.time()
+        times['transform'] += t2 - t1
+
+        _write_pending(transformer, out)
+        if tree is not None:
+            Unparser(tree, out)
+        times['unparse'] += time.time() - t2
+        stats.expressions += 1
+
+    # The root expression node
+    stats.nodes += 1
+    stats.records += 2
+    stats.output_bytes = out.count
+
+
+def translate_stream(raw, out, worker=None, cache=None, stats=None,
+                     transformer=Transformer, optimize=False):
+    """
+    Translate `raw` into the file object `out`, one top-level expression
+    at a time.
+
+    Records are read as R writes them, and each top-level expression is
+    translated and written as soon as its subtree is complete, while R is
+    still walking the ones after it. A large file then takes about as long
+    as the slower of R and Python, rather than the two added together.
+
+    If `stats` is a TranslateStats, it is filled in with timings and
+    counts for each stage.
+
+    `transformer` is the Transformer class that builds the Python AST,
+    such as NumpyTransformer. With `optimize`, constants are folded and
+    dead code is removed (see optimize.Optimizer).
+    """
+    if worker is None:
+        worker = default_worker()
+
+    transformer = transformer()
+    optimizer = Optimizer() if optimize else None
+
+    if stats is not None:
+        return _translate_timed(raw, out, worker, cache, stats, transformer,
+                                optimizer)
+
+    if cache is None:
+        cue_out = worker.stream(raw)
+    else:
+        cue_out = run_cue(raw, worker, cache)
+
+    try:
+        _write_pending(transformer, out)
+        for node in read_subtrees(cue_out, CueGeneric, format=worker.format):
+            _unparse(transformer, transformer.visit(node), out, optimizer)
+    finally:
+        if cache is None:
+            cue_out.close()
+
+
+def translate(raw, worker=None, cache=None, transformer=Transformer,
+              optimize=False):
+    out = StringIO()
+    translate_stream(raw, out, worker, cache, transformer=transformer,
+                     optimize=optimize)
+    return out.getvalue()
+
+
+def translate_with_stats(raw, worker=None, cache=None, log_stats=False,
+                         profile=None, transformer=Transformer,
+                         optimize=False):
+    """
+    Translate `raw`, returning the Python source and a TranslateStats.
+
+    With `log_stats`, the stats are also logged to the 'cue.translate'
+    logger. With `profile`, the translation runs under cProfile and the
+    profile is dumped to that path, for reading with pstats.
+    """
+    out = StringIO()
+    stats = TranslateStats()
+
+    if profile is None:
+        translate_stream(raw, out, worker, cache, stats, transformer, optimize)
+    else:
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(translate_stream, raw, out, worker, cache, stats,
+                             transformer, optimize)
+        finally:
+            profiler.dump_stats(profile)
+
+    if log_stats:
+        stats.log()
+
+    return out.getvalue(), stats
+
+
+def translate_many(sources, workers=None, ordered=True, pool=None, cache=None,
+                   raise_errors=True, transformer=Transformer,
+                   optimize=False):
+    """
+    Translate an iterable of R sources on a pool of warm cue workers.
+
+    Yields translations in input order, or (index, translation) pairs as
+    they complete when `ordered` is False. A failed translation raises its
+    exception when its result would have been yielded, or, if
+    `raise_errors` is False, is yielded as the exception instance. An
+    exception raised by `sources` itself is raised after the translations
+    of the sources before it.
+
+    If no `pool` is given, a CuePool of `workers` processes is started
+    and closed around the batch. Sources found in `cache` skip R entirely.
+    """
+    own_pool = pool is None
+    if own_pool:
+        pool = CuePool(workers)
+
+    tasks = Queue.Queue(maxsize=pool.size * 2)
+    results = Queue.Queue()
+    stop = threading.Event()
+
+    def feed():
+        try:
+            for item in enumerate(sources):
+                if stop.is_set():
+                    break
+                tasks.put(item)
+        except Exception:
+            # Raised by `sources`: handed to the caller once the sources
+            # read before it are done
+            results.put((None, None, sys.exc_info()))
+        finally:
+            for i in range(pool.size):
+                tasks.put(None)
+
+    def work():
+        while True:
+            item = tasks.get()
+            if item is None:
+                results.put(None)
+                return
+
+            # Abandoned by the caller: drain the queue so feed() can finish
+            if stop.is_set():
+                continue
+
+            i, raw = item
+            try:
+                code = translate(raw, pool, cache, transformer, optimize)
+                results.put((i, code, None))
+            except Exception:
+                results.put((i, None, sys.exc_info()))
+
+    threads = [threading.Thread(target=feed)]
+    threads += [threading.Thread(target=work) for i in range(pool.size)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    try:
+        pending = {}
+        next_index = 0
+        running = pool.size
+        sources_exc_info = None
+
+        while running:
+            result = results.get()
+            if result is None:
+                running -= 1
+                continue
+
+            i, code, exc_info = result
+            if i is None:
+                sources_exc_info = exc_info
+                continue
+
+            if not ordered:
+                if exc_info:
+                    if raise_errors:
+                        raise exc_info[0], exc_info[1], exc_info[2]
+                    code = exc_info[1]
+                yield i, code
+                continue
+
+            pending[i] = result
+            while next_index in pending:
+                i, code, exc_info = pending.pop(next_index)
+                next_index += 1
+                if exc_info:
+                    if raise_errors:
+                        raise exc_info[0], exc_info[1], exc_info[2]
+                    code = exc_info[1]
+                yield code
+
+        if sources_exc_info:
+            raise sources_exc_info[0], sources_exc_info[1], sources_exc_info[2]
+
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        if own_pool:
+            pool.close()
+
+
+# Translating whole trees
+
+_tree_worker = None
+_tree_cache = None
+_tree_transformer = Transformer
+_tree_optimize = False
+
+def _init_tree_worker(backend, format, cache_path, transformer, optimize,
+                      limits):
+    """Start one translation backend in each process of the pool."""
+    global _tree_worker, _tree_cache, _tree_transformer, _tree_optimize
+
+    # Interrupts are handled by the parent, which terminates the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    if backend == 'python':
+        import rparse
+        _tree_worker = rparse.ParserWorker(format)
+    else:
+        _tree_worker = CueWorker(format=format, **limits)
+
+    if cache_path is not None:
+        _tree_cache = CueCache(cache_path)
+    _tree_transformer = transformer
+    _tree_optimize = optimize
+
+
+def _translate_tree_file(paths):
+    """
+    Translate one file in a pool process. Returns (source path, bytes read,
+    seconds taken, error message or None).
+    """
+    path, out_path = paths
+    start = time.time()
+    size = 0
+
+    try:
+        with open(path, 'rb') as fh:
+            raw = fh.read()
+        size = len(raw)
+        code = translate(raw, _tree_worker, _tree_cache, _tree_transformer,
+                         _tree_optimize)
+        # Some R translates to code Python rejects, such as a return()
+        # outside of a function
+        compile(code, out_path, 'exec')
+
+        out_dir = os.path.dirname(out_path)
+        if out_dir and not os.path.isdir(out_dir):
+            try:
+                os.makedirs(out_dir)
+            except OSError:
+                # Made by another process in the meantime
+                if not os.path.isdir(out_dir):
+                    raise
+
+        tmp_path = out_path + '.tmp'
+        with open(tmp_path, 'wb') as fh:
+            fh.write(code)
+        os.rename(tmp_path, out_path)
+    except Exception as e:
+        error = str(e) or e.__class__.__name__
+        return path, size, time.time() - start, error
+
+    return path, size, time.time() - start, None
+
+
+def tree_outputs(src, dest=None, force=False):
+    """
+    Pair each R source under `src` with the path of its translation: the
+    same relative path under `dest`, or next to the source if no `dest` is
+    given, with a .py extension. Sources whose output is newer than they
+    are are left out, unless `force` is set.
+    """
+    from watch import find_sources
+
+    pairs = []
+    for path in find_sources(src):
+        out_path = os.path.splitext(path)[0] + '.py'
+        if dest is not None:
+            out_path = os.path.join(dest, os.path.relpath(out_path, src))
+
+        if not force:
+            try:
+                if os.path.getmtime(out_path) >= os.path.getmtime(path):
+                    continue
+            except OSError:
+                pass
+
+        pairs.append((path, out_path))
+
+    return pairs
+
+
+def translate_tree(src, dest=None, processes=None, backend='r',
+                   format='framed', cache=None, force=False,
+                   transformer=Transformer, optimize=False, **limits):
+    """
+    Translate every R source under `src` on a pool of `processes`
+    processes, each with its own backend: a CueWorker for 'r', or an
+    rparse.ParserWorker for 'python'. `cache` is the path of a CueCache
+    shared by the processes. `transformer` and `optimize` are as for
+    translate(), and `limits` are passed on to each CueWorker.
+
+    Yields (source path, bytes read, seconds taken, error message or None)
+    for each file as it completes. A translation that Python can't compile
+    is reported as an error and not written. Larger files are started
+    first, so one large file doesn't hold up the end of the run.
+    """
+    pairs = tree_outputs(src, dest, force)
+    if not pairs:
+        return
+
+    pairs.sort(key=lambda pair: os.path.getsize(pair[0]), reverse=True)
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(pairs))
+
+    pool = multiprocessing.Pool(processes, _init_tree_worker,
+                                (backend, format, cache, transformer,
+                                 optimize, limits))
+    try:
+        for result in pool.imap_unordered(_translate_tree_file, pairs):
+            yield result
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def main(args):
+    parser = argparse.ArgumentParser(
+        description='Translate a tree of R sources to Python.')
+    parser.add_argument('src', help='directory of R sources')
+    parser.add_argument('dest', nargs='?', default=None,
+                        help='directory to mirror the translations into '
+                             '(default: next to the sources)')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='processes (default: one per CPU)')
+    parser.add_argument('--backend', choices=['r', 'python'], default='r',
+                        help='parse with cue.r, or with the pure-Python '
+                             'rparse module')
+    parser.add_argument('--cache', default=None,
+                        help='directory for a cache of parser output')
+    parser.add_argument('--numpy', action='store_true',
+                        help='translate vector arithmetic to NumPy')
+    parser.add_argument('--optimize', action='store_true',
+                        help='fold constants and remove dead code')
+    parser.add_argument('--force', action='store_true',
+                        help='translate sources whose output is up to date')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='seconds R may take over one file')
+    opts = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    limits = {}
+    if opts.timeout is not None:
+        limits['timeout'] = opts.timeout
+
+    start = time.time()
+    done = failed = total_bytes = 0
+
+    for path, size, elapsed, error in translate_tree(
+            opts.src, opts.dest, opts.jobs, opts.backend, cache=opts.cache,
+            force=opts.force,
+            transformer=NumpyTransformer if opts.numpy else Transformer,
+            optimize=opts.optimize, **limits):
+        done += 1
+        total_bytes += size
+        if error is None:
+            log.info('OK   %s (%.3fs)', path, elapsed)
+        else:
+            failed += 1
+            log.error('FAIL %s: %s', path, error)
+
+    elapsed = time.time() - start
+    log.info('%d files, %d failed, %.1f KB in %.2fs: %.1f files/s, %.1f KB/s',
+             done, failed, total_bytes / 1024.0, elapsed,
+             done / elapsed if elapsed else 0,
+             total_bytes / 1024.0 / elapsed if elapsed else 0)
+
+    return 1 if failed else 0
+
 
 if __name__ == '__main__':
-    #print translate('1 %in% foo')
-    #print translate('funcname <- function(x) return()')
-    #print translate('foo <- bar')
-    #print translate('foo(1)(bar())')
-    print translate('foo[[1]]')
+    sys.exit(main(sys.argv[1:]))
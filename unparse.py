@@ -26,23 +26,40 @@ class Unparser:
     output source code for the abstract syntax; original formatting
     is disregarded. """
 
-    def __init__(self, tree, file = sys.stdout):
-        """Unparser(tree, file=sys.stdout) -> None.
-         Print the source for tree to file."""
+    def __init__(self, tree, file = sys.stdout, chunk_size = 4096):
+        """Unparser(tree, file=sys.stdout, chunk_size=4096) -> None.
+         Print the source for tree to file.
+
+         Output fragments are collected in a buffer, which is written to
+         file in one piece once it holds chunk_size fragments (checked at
+         the start of each line) and when unparsing is done."""
         self.f = file
+        self.chunk_size = chunk_size
+        self._handlers = self._dispatch_cache()
+        self._buffer = []
+        # write() is called for nearly every token, so skip the method call
+        # and append to the buffer directly.
+        self.write = self._buffer.append
         self.future_imports = []
         self._indent = 0
         self.dispatch(tree)
-        self.f.write("")
+        self.flush()
         self.f.flush()
 
+    def flush(self):
+        "Write the buffered output to the file."
+        self.f.write("".join(self._buffer))
+        del self._buffer[:]
+
     def fill(self, text = ""):
         "Indent a piece of text, according to the current indentation level"
-        self.f.write("\n"+"    "*self._indent + text)
+        if len(self._buffer) >= self.chunk_size:
+            self.flush()
+        self._buffer.append("\n"+"    "*self._indent + text)
 
     def write(self, text):
         "Append a piece of text to the current line."
-        self.f.write(text)
+        self._buffer.append(text)
 
     def enter(self):
         "Print ':', and increase the indentation."
@@ -53,14 +70,35 @@ class Unparser:
         "Decrease the indentation level."
         self._indent -= 1
 
+    def _dispatch_cache(self):
+        "The node type -> handler cache for this class, shared by instances."
+        cls = self.__class__
+        if "_handler_cache" not in cls.__dict__:
+            cls._handler_cache = {}
+        return cls._handler_cache
+
+    def _handler(self, node_type):
+        "Look up and cache the handler function for node_type."
+        meth = getattr(self.__class__, "_"+node_type.__name__).im_func
+        self._handlers[node_type] = meth
+        return meth
+
     def dispatch(self, tree):
         "Dispatcher function, dispatching tree type T to method _T."
         if isinstance(tree, list):
-            for t in tree:
-                self.dispatch(t)
+            self.dispatch_list(tree)
             return
-        meth = getattr(self, "_"+tree.__class__.__name__)
-        meth(tree)
+        node_type = tree.__class__
+        meth = self._handlers.get(node_type) or self._handler(node_type)
+        meth(self, tree)
+
+    def dispatch_list(self, trees):
+        "Dispatch each node of a statement (or other node) list in turn."
+        handlers = self._handlers
+        for tree in trees:
+            node_type = tree.__class__
+            meth = handlers.get(node_type) or self._handler(node_type)
+            meth(self, tree)
 
 
     ############### Unparsing methods ######################
@@ -71,8 +109,7 @@ class Unparser:
     ########################################################
 
     def _Module(self, tree):
-        for stmt in tree.body:
-            self.dispatch(stmt)
+        self.dispatch_list(tree.body)
 
     # stmt
     def _Expr(self, tree):
@@ -419,50 +456,69 @@ class Unparser:
             interleave(lambda: self.write(", "), self.dispatch, t.elts)
         self.write(")")
 
+    # Operator expressions and calls are written from an explicit stack
+    # instead of recursing through dispatch, so that long chains such as
+    # 1 + 2 + ... + n, or np.add(np.add(...), n), don't hit the recursion
+    # limit. Each _*_parts method returns the pieces of one node: strings
+    # to write, and operands, which are expanded the same way if they are
+    # operators or calls themselves and dispatched otherwise.
+    def _chain(self, tree):
+        stack = [tree]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, str):
+                self.write(item)
+                continue
+
+            parts = self.chain_parts.get(item.__class__)
+            if parts is None:
+                self.dispatch(item)
+            else:
+                stack.extend(reversed(parts(self, item)))
+
     unop = {"Invert":"~", "Not": "not", "UAdd":"+", "USub":"-"}
-    def _UnaryOp(self, t):
-        self.write("(")
-        self.write(self.unop[t.op.__class__.__name__])
-        self.write(" ")
+    def _UnaryOp_parts(self, t):
+        parts = ["(", self.unop[t.op.__class__.__name__], " "]
         # If we're applying unary minus to a number, parenthesize the number.
         # This is necessary: -2147483648 is different from -(2147483648) on
         # a 32-bit machine (the first is an int, the second a long), and
         # -7j is different from -(7j).  (The first has real part 0.0, the second
         # has real part -0.0.)
         if isinstance(t.op, ast.USub) and isinstance(t.operand, ast.Num):
-            self.write("(")
-            self.dispatch(t.operand)
-            self.write(")")
+            parts += ["(", t.operand, ")"]
         else:
-            self.dispatch(t.operand)
-        self.write(")")
+            parts.append(t.operand)
+        parts.append(")")
+        return parts
 
     binop = { "Add":"+", "Sub":"-", "Mult":"*", "Div":"/", "Mod":"%",
                     "LShift":"<<", "RShift":">>", "BitOr":"|", "BitXor":"^", "BitAnd":"&",
                     "FloorDiv":"//", "Pow": "**"}
-    def _BinOp(self, t):
-        self.write("(")
-        self.dispatch(t.left)
-        self.write(" " + self.binop[t.op.__class__.__name__] + " ")
-        self.dispatch(t.right)
-        self.write(")")
+    def _BinOp_parts(self, t):
+        op = " " + self.binop[t.op.__class__.__name__] + " "
+        return ["(", t.left, op, t.right, ")"]
 
     cmpops = {"Eq":"==", "NotEq":"!=", "Lt":"<", "LtE":"<=", "Gt":">", "GtE":">=",
                         "Is":"is", "IsNot":"is not", "In":"in", "NotIn":"not in"}
-    def _Compare(self, t):
-        self.write("(")
-        self.dispatch(t.left)
+    def _Compare_parts(self, t):
+        parts = ["(", t.left]
         for o, e in zip(t.ops, t.comparators):
-            self.write(" " + self.cmpops[o.__class__.__name__] + " ")
-            self.dispatch(e)
-        self.write(")")
+            parts += [" " + self.cmpops[o.__class__.__name__] + " ", e]
+        parts.append(")")
+        return parts
 
     boolops = {ast.And: 'and', ast.Or: 'or'}
-    def _BoolOp(self, t):
-        self.write("(")
+    def _BoolOp_parts(self, t):
         s = " %s " % self.boolops[t.op.__class__]
-        interleave(lambda: self.write(s), self.dispatch, t.values)
-        self.write(")")
+        parts = ["("]
+        for i, value in enumerate(t.values):
+            if i:
+                parts.append(s)
+            parts.append(value)
+        parts.append(")")
+        return parts
+
+    _UnaryOp = _BinOp = _Compare = _BoolOp = _chain
 
     def _Attribute(self,t):
         self.dispatch(t.value)
@@ -474,29 +530,33 @@ class Unparser:
         self.write(".")
         self.write(t.attr)
 
-    def _Call(self, t):
-        self.dispatch(t.func)
-        self.write("(")
+    def _Call_parts(self, t):
+        parts = [t.func, "("]
         comma = False
         for e in t.args:
-            if comma: self.write(", ")
+            if comma: parts.append(", ")
             else: comma = True
-            self.dispatch(e)
+            parts.append(e)
         for e in t.keywords:
-            if comma: self.write(", ")
+            if comma: parts.append(", ")
             else: comma = True
-            self.dispatch(e)
+            parts.append(e)
         if t.starargs:
-            if comma: self.write(", ")
+            if comma: parts.append(", ")
             else: comma = True
-            self.write("*")
-            self.dispatch(t.starargs)
+            parts += ["*", t.starargs]
         if t.kwargs:
-            if comma: self.write(", ")
+            if comma: parts.append(", ")
             else: comma = True
-            self.write("**")
-            self.dispatch(t.kwargs)
-        self.write(")")
+            parts += ["**", t.kwargs]
+        parts.append(")")
+        return parts
+
+    _Call = _chain
+
+    chain_parts = {ast.UnaryOp: _UnaryOp_parts, ast.BinOp: _BinOp_parts,
+                   ast.Compare: _Compare_parts, ast.BoolOp: _BoolOp_parts,
+                   ast.Call: _Call_parts}
 
     def _Subscript(self, t):
         self.dispatch(t.value)
@@ -575,6 +635,12 @@ def roundtrip(filename, output=sys.stdout):
     Unparser(tree, output)
 
 
+def unparse_file(tree, filename, chunk_size=4096):
+    "Write the source for tree straight to the file at filename."
+    with open(filename, "w") as output:
+        Unparser(tree, output, chunk_size)
+
+
 
 def testdir(a):
     try:
@@ -0,0 +1,331 @@
+"""
+Keep translated Python in sync with a tree of R sources.
+
+    python watch.py [--interval SECONDS] [--debounce SECONDS]
+                    [--workers N] [--status-port PORT] DIRECTORY
+
+Every `foo.r` under DIRECTORY is translated to `foo.py` next to it, once
+at startup if the output is missing or older than the source, and again
+whenever the source changes. Changes are batched and translated on a pool
+of warm cue workers, so R is started once per worker, not once per file.
+
+Changes are found with inotify when pyinotify is installed, and by
+polling file modification times otherwise.
+"""
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+from translate import CuePool, translate_many
+
+
+log = logging.getLogger('cue.watch')
+
+
+def is_source(path):
+    return os.path.splitext(path)[1] in ('.r', '.R')
+
+
+def output_path(path):
+    return os.path.splitext(path)[0] + '.py'
+
+
+def find_sources(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [name for name in dirnames if not name.startswith('.')]
+        for name in filenames:
+            if is_source(name):
+                yield os.path.join(dirpath, name)
+
+
+def is_stale(path):
+    try:
+        return os.path.getmtime(output_path(path)) < os.path.getmtime(path)
+    except OSError:
+        return True
+
+
+class PollingWatcher(object):
+
+    """
+    Finds changed R sources by comparing modification times and sizes.
+
+    The first poll() reports nothing; it records the state of the tree.
+    """
+
+    def __init__(self, root, interval=1.0):
+        self.root = root
+        self.interval = interval
+        self._state = self._scan()
+
+    def _scan(self):
+        state = {}
+        for path in find_sources(self.root):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            state[path] = (st.st_mtime, st.st_size)
+        return state
+
+    def poll(self, timeout=None):
+        """
+        Return the set of sources that were created or modified since the
+        last poll, waiting up to `timeout` seconds (default `interval`)
+        for one to appear.
+        """
+        if timeout is None:
+            timeout = self.interval
+
+        deadline = time.time() + timeout
+        while True:
+            state = self._scan()
+            changed = set(path for path, stat in state.iteritems()
+                          if self._state.get(path) != stat)
+            self._state = state
+
+            remaining = deadline - time.time()
+            if changed or remaining <= 0:
+                return changed
+
+            time.sleep(min(self.interval, remaining))
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+
+    """Finds changed R sources with inotify. Requires pyinotify."""
+
+    def __init__(self, root, interval=1.0):
+        self.root = root
+        self.interval = interval
+        self._changed = set()
+
+        watcher = self
+
+        class Handler(pyinotify.ProcessEvent):
+            def process_default(self, event):
+                if not event.dir and is_source(event.pathname):
+                    watcher._changed.add(event.pathname)
+
+        mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO
+        self._manager = pyinotify.WatchManager()
+        self._manager.add_watch(root, mask, rec=True, auto_add=True)
+        self._notifier = pyinotify.Notifier(self._manager, Handler())
+
+    def poll(self, timeout=None):
+        if timeout is None:
+            timeout = self.interval
+
+        if self._notifier.check_events(int(timeout * 1000)):
+            self._notifier.read_events()
+            self._notifier.process_events()
+
+        changed, self._changed = self._changed, set()
+        return changed
+
+    def close(self):
+        self._notifier.stop()
+
+
+def make_watcher(root, interval=1.0):
+    if pyinotify is not None:
+        return InotifyWatcher(root, interval)
+    return PollingWatcher(root, interval)
+
+
+class Daemon(object):
+
+    """
+    Translates changed R sources in batches.
+
+    A change is held until no further changes have arrived for `debounce`
+    seconds, so an editor's burst of writes, or a checkout touching many
+    files, becomes one batch. Each batch is translated with
+    translate_many() on `pool`.
+
+    status() reports the number of changes waiting, what has been
+    translated so far and how long the last batch took, from the first
+    change in it being seen to its last output being written.
+    """
+
+    def __init__(self, root, pool=None, cache=None, watcher=None,
+                 debounce=0.2):
+        self.root = root
+        self.pool = pool if pool is not None else CuePool()
+        self.cache = cache
+        self.watcher = watcher if watcher is not None else make_watcher(root)
+        self.debounce = debounce
+
+        self.translated = 0
+        self.failed = {}
+        self.last_latency = None
+
+        self._pending = {}
+        self._last_change = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def status(self):
+        with self._lock:
+            return {
+                'root': self.root,
+                'queued': len(self._pending),
+                'translated': self.translated,
+                'failed': dict(self.failed),
+                'last_latency': self.last_latency,
+            }
+
+    def queue(self, paths, now=None):
+        if now is None:
+            now = time.time()
+
+        with self._lock:
+            for path in paths:
+                self._pending.setdefault(path, now)
+            if paths:
+                self._last_change = now
+
+    def ready(self, now=None):
+        """Take the pending batch, if changes have settled."""
+        if now is None:
+            now = time.time()
+
+        with self._lock:
+            if not self._pending or now - self._last_change < self.debounce:
+                return {}
+
+            batch, self._pending = self._pending, {}
+            return batch
+
+    def sync(self, paths):
+        """Translate `paths` and write their outputs."""
+        sources = []
+        for path in paths:
+            try:
+                with open(path, 'rb') as fh:
+                    sources.append((path, fh.read()))
+            except IOError as e:
+                # Deleted or renamed since the change was seen
+                log.debug('skipping %s: %s', path, e)
+
+        results = translate_many([raw for path, raw in sources],
+                                 pool=self.pool, cache=self.cache,
+                                 ordered=False, raise_errors=False)
+
+        for i, code in results:
+            path = sources[i][0]
+            if isinstance(code, Exception):
+                log.error('FAIL %s: %s', path, code)
+                with self._lock:
+                    self.failed[path] = str(code)
+                continue
+
+            out_path = output_path(path)
+            tmp_path = out_path + '.tmp'
+            with open(tmp_path, 'wb') as fh:
+                fh.write(code)
+            os.rename(tmp_path, out_path)
+
+            log.info('OK %s', path)
+            with self._lock:
+                self.translated += 1
+                self.failed.pop(path, None)
+
+    def step(self, timeout=None):
+        """Wait for changes, then translate a batch if one is ready."""
+        self.queue(self.watcher.poll(timeout))
+
+        batch = self.ready()
+        if batch:
+            self.sync(sorted(batch))
+            latency = time.time() - min(batch.itervalues())
+            with self._lock:
+                self.last_latency = latency
+            log.info('translated %d files in %.3fs', len(batch), latency)
+
+    def run(self):
+        stale = [path for path in find_sources(self.root) if is_stale(path)]
+        if stale:
+            log.info('translating %d stale files', len(stale))
+            self.sync(stale)
+
+        log.info('watching %s', self.root)
+        while not self._stop.is_set():
+            self.step(min(self.debounce, self.watcher.interval))
+
+    def stop(self):
+        self._stop.set()
+
+    def close(self):
+        self.watcher.close()
+        self.pool.close()
+
+
+def serve_status(daemon, port, host='127.0.0.1'):
+    """Serve daemon.status() as JSON over HTTP from a background thread."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps(daemon.status())
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            log.debug(format, *args)
+
+    server = HTTPServer((host, port), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('root')
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help='seconds between polls, without inotify')
+    parser.add_argument('--debounce', type=float, default=0.2,
+                        help='seconds to wait for changes to settle')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='cue workers (default: one per CPU)')
+    parser.add_argument('--status-port', type=int, default=None,
+                        help='serve status as JSON on this port')
+    opts = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    daemon = Daemon(opts.root, CuePool(opts.workers),
+                    watcher=make_watcher(opts.root, opts.interval),
+                    debounce=opts.debounce)
+
+    if opts.status_port is not None:
+        serve_status(daemon, opts.status_port)
+
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])